@@ -0,0 +1,719 @@
+#!/usr/bin/env python
+
+"""
+capture.py
+
+Supervise long running collectors, e.g. DTrace scripts, snoop and smbstat,
+and bound the disk space their output uses.
+
+The output of each collector is written to segments which are rotated by
+size or age. Closed segments are compressed in the background and the
+oldest segments are removed whenever the capture exceeds its disk budget.
+
+Collectors are given as NAME=COMMAND. The output written to STDOUT/STDERR
+is rotated at line boundaries. A collector which writes its own output file,
+e.g. `snoop -o`, is given with an {output} placeholder in its command and is
+restarted with a new output file for every segment.
+
+The supervisor and collector PIDs are tracked in a state file so a capture
+started in the background can be queried and stopped.
+
+Copyright (c) 2016  Nexenta Systems
+William Kettler <william.kettler@nexenta.com>
+"""
+
+import os
+import sys
+import gzip
+import json
+import time
+import errno
+import getopt
+import shlex
+import shutil
+import signal
+import threading
+import subprocess
+import Queue
+
+# Defaults, sizes are in MB and times in seconds
+segment_size = 100
+segment_time = 3600
+budget = 1024
+
+# Seconds to wait for collectors to exit before they are killed
+grace = 5
+
+
+def usage():
+    """
+    Print usage.
+
+    Inputs:
+        None
+    Outputs:
+        None
+    """
+    cmd = sys.argv[0]
+
+    print "%s start|run -S STATE -d DIR [-s MB] [-t SECONDS] [-b MB] [-n] " \
+          "NAME=COMMAND..." % cmd
+    print "%s status|stop -S STATE" % cmd
+    print ""
+    print "Supervise collectors and rotate, compress and bound their output."
+    print ""
+    print "Commands:"
+    print ""
+    print "    start                start the capture in the background"
+    print "    run                  run the capture until interrupted"
+    print "    status               report the state of each collector"
+    print "    stop                 stop the capture"
+    print ""
+    print "Arguments:"
+    print ""
+    print "    -h, --help           print usage"
+    print "    -S, --state STATE    state file"
+    print "    -d, --dir DIR        output directory"
+    print "    -s, --size MB        rotate segments larger than MB, " \
+          "defaults to %d" % segment_size
+    print "    -t, --time SECONDS   rotate segments older than SECONDS, " \
+          "defaults to"
+    print "                         %d, 0 disables" % segment_time
+    print "    -b, --budget MB      disk budget for the capture, defaults " \
+          "to %d" % budget
+    print "    -n, --no-compress    do not compress closed segments"
+
+
+def log(msg, level="INFO"):
+    sys.stdout.write("%s [%s] %s\n" % (time.strftime("%Y-%m-%d:%H:%M:%S"),
+                                       level, msg))
+    sys.stdout.flush()
+
+
+def pid_alive(pid):
+    """
+    Return whether a process exists.
+
+    Inputs:
+        pid (int): Process ID
+    Outputs:
+        alive (bool): True if the process exists
+    """
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def read_state(path):
+    """
+    Read the state file.
+
+    Inputs:
+        path (str): State file
+    Outputs:
+        state (dict): Capture state, None if there is no capture
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def write_state(path, state):
+    """
+    Replace the state file atomically.
+
+    Inputs:
+        path   (str): State file
+        state (dict): Capture state
+    Outputs:
+        None
+    """
+    tmp = "%s.%d" % (path, os.getpid())
+    with open(tmp, "w") as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.rename(tmp, path)
+
+
+class Segments(object):
+    """
+    The closed segments of a capture, oldest first. Segments are compressed
+    by a background thread and removed oldest first while the capture is
+    over budget. The budget is enforced whenever a segment is closed, so a
+    burst of output can't rotate past it between the supervisor's checks.
+    """
+    def __init__(self, budget, compress=True, active=None):
+        """
+        Inputs:
+            budget      (int): Disk budget in bytes
+            compress   (bool): Compress closed segments
+            active (function): Returns the active segments
+        """
+        self.budget = budget
+        self.compress = compress
+        self.active = active or list
+        self.closed = []
+        self.lock = threading.Lock()
+        self.queue = Queue.Queue()
+        self.thread = threading.Thread(target=self.compressor)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self, path):
+        """
+        Add a closed segment.
+
+        Inputs:
+            path (str): Segment
+        Outputs:
+            None
+        """
+        with self.lock:
+            self.closed.append(path)
+        if self.compress:
+            self.queue.put(path)
+        self.enforce(self.active())
+
+    def compressor(self):
+        while True:
+            path = self.queue.get()
+            if path is None:
+                return
+            try:
+                self.gzip(path)
+            except (IOError, OSError), e:
+                log("compressing %s failed: %s" % (path, e), "ERROR")
+
+    def gzip(self, path):
+        """
+        Compress a segment and replace it with the compressed segment.
+
+        Inputs:
+            path (str): Segment
+        Outputs:
+            None
+        """
+        tmp = "%s.gz.tmp" % path
+        try:
+            with open(path, "rb") as src:
+                dst = gzip.open(tmp, "wb")
+                try:
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
+                finally:
+                    dst.close()
+        except IOError, e:
+            # The segment was removed to stay within the budget
+            if e.errno == errno.ENOENT:
+                return
+            raise
+
+        with self.lock:
+            if path not in self.closed:
+                # Removed by enforce() along with the partial copy
+                try:
+                    os.unlink(tmp)
+                except OSError:
+                    pass
+                return
+            os.rename(tmp, "%s.gz" % path)
+            os.unlink(path)
+            self.closed[self.closed.index(path)] = "%s.gz" % path
+
+    def enforce(self, active):
+        """
+        Remove the oldest closed segments until the capture is within
+        budget. Active segments are never removed.
+
+        Inputs:
+            active (list): Active segments
+        Outputs:
+            None
+        """
+        with self.lock:
+            # A segment being rotated is both active and closed
+            total = sum(self.usage(p) for p in self.closed) + \
+                sum(size(p) for p in active if p not in self.closed)
+            while total > self.budget and self.closed:
+                path = self.closed.pop(0)
+                total -= self.usage(path)
+                try:
+                    os.unlink(path)
+                    log("removed %s to stay within budget" % path)
+                except OSError:
+                    pass
+                try:
+                    os.unlink("%s.gz.tmp" % path)
+                except OSError:
+                    pass
+
+    def usage(self, path):
+        """
+        Return the disk space a closed segment uses, including its
+        compressed copy while it is being compressed.
+
+        Inputs:
+            path (str): Segment
+        Outputs:
+            bytes (int): Disk space used
+        """
+        return size(path) + size("%s.gz.tmp" % path)
+
+    def drain(self):
+        """
+        Wait for every closed segment to be compressed.
+
+        Inputs:
+            None
+        Outputs:
+            None
+        """
+        self.queue.put(None)
+        while self.thread.is_alive():
+            self.thread.join(1)
+
+
+def size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+class Collector(object):
+    """
+    A collector process and the segment its output is written to.
+    """
+    def __init__(self, name, command, directory, limits, segments):
+        """
+        Inputs:
+            name         (str): Collector name, the segment file prefix
+            command      (str): Command, {output} is replaced by the segment
+            directory    (str): Output directory
+            limits     (tuple): (bytes, seconds) rotation limits
+            segments (Segments): Closed segments
+        """
+        self.name = name
+        self.command = command
+        self.directory = directory
+        self.size, self.age = limits
+        self.segments = segments
+        self.filemode = "{output}" in command
+        self.lock = threading.Lock()
+        self.seq = 0
+        self.phandle = None
+        self.segment = None
+        self.fhandle = None
+        self.opened = None
+        self.written = 0
+
+    def next_segment(self):
+        self.seq += 1
+        self.segment = os.path.join(self.directory, "%s.%05d" %
+                                    (self.name, self.seq))
+        self.opened = time.time()
+        self.written = 0
+
+    def start(self):
+        """
+        Start the collector writing to a new segment.
+
+        Inputs:
+            None
+        Outputs:
+            None
+        """
+        self.next_segment()
+        # Collectors are started with Popen rather than the command module,
+        # they outlive any one read, write binary output straight to their
+        # segments and are stopped gracefully by terminate()
+        devnull = open(os.devnull, "r+")
+        try:
+            if self.filemode:
+                argv = [a.replace("{output}", self.segment)
+                        for a in shlex.split(self.command)]
+                self.phandle = subprocess.Popen(argv, stdin=devnull,
+                                                stdout=devnull,
+                                                stderr=devnull,
+                                                close_fds=True)
+            else:
+                self.fhandle = open(self.segment, "wb")
+                self.phandle = subprocess.Popen(shlex.split(self.command),
+                                                stdin=devnull,
+                                                stdout=subprocess.PIPE,
+                                                stderr=subprocess.STDOUT,
+                                                close_fds=True)
+                t = threading.Thread(target=self.reader)
+                t.daemon = True
+                t.start()
+        finally:
+            devnull.close()
+        log("started %s (pid %d): %s" % (self.name, self.phandle.pid,
+                                         self.command))
+
+    def due(self):
+        return ((self.size and self.written >= self.size) or
+                (self.age and time.time() - self.opened >= self.age))
+
+    def reader(self):
+        """
+        Copy the collector output to its segments, rotating at line
+        boundaries once a segment is due.
+        """
+        fd = self.phandle.stdout.fileno()
+        while True:
+            try:
+                chunk = os.read(fd, 65536)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                break
+            if not chunk:
+                break
+            with self.lock:
+                if self.due():
+                    # Finish the current line first unless it is
+                    # unreasonably long
+                    nl = chunk.find("\n") + 1
+                    if nl or (self.size and self.written >= 2 * self.size):
+                        self.fhandle.write(chunk[:nl])
+                        self.rotate_file()
+                        chunk = chunk[nl:]
+                self.fhandle.write(chunk)
+                self.written += len(chunk)
+        with self.lock:
+            self.fhandle.close()
+            self.segments.close(self.segment)
+            self.fhandle = None
+
+    def rotate_file(self):
+        self.fhandle.close()
+        self.segments.close(self.segment)
+        self.next_segment()
+        self.fhandle = open(self.segment, "wb")
+
+    def check(self):
+        """
+        Rotate a collector that writes its own output once its segment is
+        due by restarting it with a new output file.
+
+        Inputs:
+            None
+        Outputs:
+            None
+        """
+        if not self.filemode or not self.alive():
+            return
+        self.written = size(self.segment)
+        if self.due():
+            self.terminate()
+            self.segments.close(self.segment)
+            self.start()
+
+    def alive(self):
+        return self.phandle is not None and self.phandle.poll() is None
+
+    def active(self):
+        return [self.segment] if self.alive() and self.segment else []
+
+    def terminate(self):
+        """
+        Stop the collector, killing it if it doesn't exit within the grace
+        period.
+
+        Inputs:
+            None
+        Outputs:
+            None
+        """
+        if not self.alive():
+            return
+        self.phandle.terminate()
+        deadline = time.time() + grace
+        while self.phandle.poll() is None and time.time() < deadline:
+            time.sleep(0.1)
+        if self.phandle.poll() is None:
+            self.phandle.kill()
+            self.phandle.wait()
+
+
+class Capture(object):
+    """
+    A set of collectors sharing an output directory and disk budget.
+    """
+    def __init__(self, state, directory, collectors, limits, budget,
+                 compress=True):
+        self.state = state
+        self.directory = directory
+        self.segments = Segments(budget, compress, self.active)
+        self.collectors = [Collector(n, c, directory, limits, self.segments)
+                           for n, c in collectors]
+        self.running = True
+        self.died = set()
+
+    def save(self):
+        collectors = {}
+        for c in self.collectors:
+            collectors[c.name] = {"pid": c.phandle.pid if c.phandle else None,
+                                  "command": c.command,
+                                  "segment": c.segment}
+        write_state(self.state, {"pid": os.getpid(), "dir": self.directory,
+                                 "collectors": collectors})
+
+    def stop(self, signum=None, frame=None):
+        self.running = False
+
+    def run(self):
+        """
+        Start the collectors and supervise them until stopped.
+
+        Inputs:
+            None
+        Outputs:
+            None
+        """
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        for c in self.collectors:
+            try:
+                c.start()
+            except OSError, e:
+                log("starting %s failed: %s" % (c.name, e), "ERROR")
+        self.save()
+
+        while self.running:
+            for c in self.collectors:
+                c.check()
+                if c.phandle is not None and not c.alive() and \
+                        c.name not in self.died:
+                    self.died.add(c.name)
+                    log("%s (pid %d) exited with status %d" %
+                        (c.name, c.phandle.pid, c.phandle.returncode),
+                        "ERROR")
+            self.save()
+            self.enforce()
+            time.sleep(1)
+
+        log("stopping collectors")
+        for c in self.collectors:
+            c.terminate()
+            if c.filemode and c.segment:
+                self.segments.close(c.segment)
+        # Readers close their last segment once the pipe is drained
+        deadline = time.time() + grace
+        while time.time() < deadline and \
+                any(c.fhandle is not None for c in self.collectors):
+            time.sleep(0.1)
+        self.segments.drain()
+        self.enforce()
+
+        try:
+            os.unlink(self.state)
+        except OSError:
+            pass
+        log("capture stopped")
+
+    def active(self):
+        active = []
+        for c in self.collectors:
+            active.extend(c.active())
+        return active
+
+    def enforce(self):
+        self.segments.enforce(self.active())
+
+
+def status(path):
+    """
+    Report whether the supervisor and each collector are running.
+
+    Inputs:
+        path (str): State file
+    Outputs:
+        retcode (int): 0 if everything is running, 1 otherwise
+    """
+    state = read_state(path)
+    if state is None:
+        log("capture is not running")
+        return 1
+
+    retcode = 0
+    if pid_alive(state["pid"]):
+        log("capture (pid %d) is running, output in %s" %
+            (state["pid"], state["dir"]))
+    else:
+        log("capture (pid %d) has died" % state["pid"], "ERROR")
+        retcode = 1
+
+    for name in sorted(state["collectors"]):
+        c = state["collectors"][name]
+        if c["pid"] and pid_alive(c["pid"]):
+            log("%s (pid %d) is running" % (name, c["pid"]))
+        else:
+            log("%s (pid %s) has died" % (name, c["pid"]), "ERROR")
+            retcode = 1
+
+    return retcode
+
+
+def stop(path):
+    """
+    Stop the capture. Collectors left behind by a supervisor that died are
+    killed directly.
+
+    Inputs:
+        path (str): State file
+    Outputs:
+        retcode (int): 0 if the capture was stopped, 1 otherwise
+    """
+    state = read_state(path)
+    if state is None:
+        log("capture is not running", "ERROR")
+        return 1
+
+    pid = state["pid"]
+    if pid_alive(pid):
+        log("stopping capture (pid %d)" % pid)
+        os.kill(pid, signal.SIGTERM)
+        # Compressing the last segments may take a while
+        while pid_alive(pid) and os.path.exists(path):
+            time.sleep(0.5)
+        return 0
+
+    for name, c in state["collectors"].items():
+        if c["pid"] and pid_alive(c["pid"]):
+            log("killing %s (pid %d)" % (name, c["pid"]))
+            os.kill(c["pid"], signal.SIGTERM)
+    os.unlink(path)
+    return 0
+
+
+def start(argv, path, directory):
+    """
+    Start the capture in the background. The supervisor output is written
+    to capture.log in the output directory.
+
+    Inputs:
+        argv     (list): Arguments to run the capture with
+        path      (str): State file
+        directory (str): Output directory
+    Outputs:
+        retcode (int): 0 if the capture started, 1 otherwise
+    """
+    state = read_state(path)
+    if state is not None and pid_alive(state["pid"]):
+        log("capture (pid %d) is already running" % state["pid"], "ERROR")
+        return 1
+
+    # The supervisor is detached with Popen rather than the command module
+    # as it must outlive this process
+    logfile = open(os.path.join(directory, "capture.log"), "a")
+    phandle = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                                "run"] + argv, stdin=open(os.devnull),
+                               stdout=logfile, stderr=subprocess.STDOUT,
+                               close_fds=True, preexec_fn=os.setsid)
+    logfile.close()
+
+    # Wait for the supervisor to record its collectors
+    for i in range(50):
+        if phandle.poll() is not None:
+            break
+        state = read_state(path)
+        if state is not None and state["pid"] == phandle.pid:
+            log("capture (pid %d) started, output in %s" %
+                (phandle.pid, directory))
+            return 0
+        time.sleep(0.1)
+
+    log("capture failed to start, see %s" %
+        os.path.join(directory, "capture.log"), "ERROR")
+    return 1
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in ("start", "run", "status",
+                                                "stop"):
+        usage()
+        sys.exit(2)
+    command = sys.argv[1]
+
+    # Define command line options
+    try:
+        opts, args = getopt.getopt(sys.argv[2:], ":hS:d:s:t:b:n",
+                                   ["help", "state=", "dir=", "size=",
+                                    "time=", "budget=", "no-compress"])
+    except getopt.GetoptError, err:
+        sys.stderr.write(str(err))
+        usage()
+        sys.exit(2)
+
+    # Initialize arguments
+    state = None
+    directory = None
+    size_mb = segment_size
+    age = segment_time
+    budget_mb = budget
+    compress = True
+
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif o in ("-S", "--state"):
+            state = a
+        elif o in ("-d", "--dir"):
+            directory = a
+        elif o in ("-n", "--no-compress"):
+            compress = False
+        elif o in ("-s", "--size", "-t", "--time", "-b", "--budget"):
+            try:
+                value = int(a)
+            except ValueError:
+                value = -1
+            if value < 0:
+                sys.stderr.write("%s must be a positive integer.\n" % o)
+                sys.exit(1)
+            if o in ("-s", "--size"):
+                size_mb = value
+            elif o in ("-t", "--time"):
+                age = value
+            else:
+                budget_mb = value
+
+    if state is None:
+        sys.stderr.write("A state file is required.\n")
+        sys.exit(1)
+
+    if command == "status":
+        sys.exit(status(state))
+    elif command == "stop":
+        sys.exit(stop(state))
+
+    collectors = []
+    for a in args:
+        name, sep, cmd = a.partition("=")
+        if not sep or not name or not cmd.strip():
+            sys.stderr.write("Collectors must be given as NAME=COMMAND.\n")
+            sys.exit(1)
+        collectors.append((name, cmd))
+    if directory is None or not collectors:
+        usage()
+        sys.exit(2)
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    if command == "start":
+        sys.exit(start(sys.argv[2:], state, directory))
+
+    capture = Capture(state, directory, collectors,
+                      (size_mb * 1024 * 1024, age), budget_mb * 1024 * 1024,
+                      compress)
+    capture.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -14,11 +14,15 @@ William Kettler <william.kettler@nexenta.com>
 """
 
 import re
-import subprocess
 import getopt
 import sys
-import signal
-import time
+import threading
+import Queue
+from command import run, Retcode
+from inventory import DiskIndex
+
+# Serializes output from the worker threads
+print_lock = threading.Lock()
 
 
 def usage():
@@ -32,7 +36,7 @@ def usage():
     """
     cmd = sys.argv[0]
 
-    print "%s -r [-h] [-o OPTION]" % cmd
+    print "%s -r [-h] [-f] [-j JOBS [-c JOBS]]" % cmd
     print ""
     print "Clear the ZFS label from every drive in the system that is not " \
           "part of an active pool."
@@ -41,109 +45,101 @@ def usage():
     print ""
     print "    -h, --help           print usage"
     print "    -f, --force          do not prompt user"
+    print "    -j, --jobs JOBS      format JOBS disks concurrently"
+    print "    -c, --controller-jobs JOBS"
+    print "                         max concurrent formats per controller,"
+    print "                         defaults to 1"
 
 
-class Signal(Exception):
-    """
-    This exception is raise by the signal handler.
-    """
-    pass
-
-
-class Timeout(Exception):
-    """
-    This exception is raised when the command exceeds the defined timeout
-    duration and the command is killed.
+def format_disk(disk):
     """
-    def __init__(self, cmd, timeout):
-        self.cmd = cmd
-        self.timeout = timeout
-
-    def __str__(self):
-        return "Command '%s' timed out after %d second(s)." % \
-               (self.cmd, self.timeout)
-
+    Format a drives. The easiest way to do this is to create/destroy a zpool
+    on all the drives.
 
-class Retcode(Exception):
-    """
-    This exception is raise when a command exits with a non-zero exit status.
+    Inputs:
+        disk (str): Device ID
+    Outputs:
+        error (str): Error message, None if the format succeeded
     """
-    def __init__(self, cmd, retcode, output=None):
-        self.cmd = cmd
-        self.retcode = retcode
-        self.output = output
-
-    def __str__(self):
-        return "Command '%s' returned non-zero exit status %d" % \
-               (self.cmd, self.retcode)
-
+    with print_lock:
+        print "Formatting devices %s, please be patient..." % disk
+    try:
+        run(["fdisk", "-E", "/dev/rdsk/%sp0" % disk])
+    except Retcode, r:
+        return "%s\n%s" % (str(r), r.output)
 
-def alarm_handler(signum, frame):
-    raise Signal
+    return None
 
 
-def execute(cmd, timeout=None):
+def get_controller(disk):
     """
-    Execute a command in the default shell. If a timeout is defined the command
-    will be killed if the timeout is exceeded and an exception will be raised.
+    Return the controller a device is attached to, e.g. c1 for c1t0d0.
 
     Inputs:
-        cmd     (str): Command to execute
-        timeout (int): Command timeout in seconds
+        disk (str): Device ID
     Outputs:
-        output (str): STDOUT/STDERR
+        controller (str): Controller
     """
-    # Define the timeout signal
-    if timeout:
-        signal.signal(signal.SIGALRM, alarm_handler)
-        signal.alarm(timeout)
+    m = re.match(r'(c[0-9]+)', disk)
+    if m:
+        return m.group(1)
+    return disk
 
-    try:
-        # Execute the command and wait for the subprocess to terminate
-        # STDERR is redirected to STDOUT
-        phandle = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
-                                   stderr=subprocess.STDOUT)
-
-        # Read the stdout/sterr buffers and retcode
-        output, _ = phandle.communicate()
-        retcode = phandle.poll()
-    except Signal:
-        # Kill the running process
-        phandle.kill()
-        raise Timeout(cmd=cmd, timeout=timeout)
-    except:
-        logger.debug("Unhandled exception", exc_info=True)
-        raise
-    else:
-        # Possible race condition where alarm isn't disabled in time
-        signal.alarm(0)
-
-    # Raise an exception if the command exited with non-zero exit status
-    if retcode:
-        raise Retcode(cmd, retcode, output=output)
-
-    return output
 
-
-def format_disk(disk):
+def format_disks(disks, jobs, controller_jobs=1):
     """
-    Format a drives. The easiest way to do this is to create/destroy a zpool
-    on all the drives.
+    Format drives from a pool of worker threads. No more than controller_jobs
+    drives attached to the same controller are formatted at once.
 
     Inputs:
-        disk (str): Device ID
+        disks          (list): Device IDs
+        jobs            (int): Number of worker threads
+        controller_jobs (int): Max concurrent formats per controller
     Outputs:
-        None
+        errors (dict): Error messages keyed by device ID
     """
-    print "Formatting devices %s, please be patient..." % disk
-    try:
-        output = execute("fdisk -E /dev/rdsk/%sp0" % disk)
-    except Retcode, r:
-        sys.stderr.write(str(r))
-        sys.stderr.write(r.output)
-        sys.stderr.write("Please review /var/adm/messages for additional "
-                         "information.\n")
-        sys.exit(1)
+    work = Queue.Queue()
+    errors = {}
+    limits = {}
+
+    # Interleave drives from different controllers so the workers spread out
+    # across controllers rather than queuing behind a single limit
+    by_controller = {}
+    for d in disks:
+        c = get_controller(d)
+        by_controller.setdefault(c, []).append(d)
+        limits[c] = threading.Semaphore(controller_jobs)
+    while by_controller:
+        for c in sorted(by_controller):
+            work.put(by_controller[c].pop(0))
+            if not by_controller[c]:
+                del by_controller[c]
+
+    def worker():
+        while True:
+            try:
+                d = work.get_nowait()
+            except Queue.Empty:
+                return
+            with limits[get_controller(d)]:
+                error = format_disk(d)
+            if error is not None:
+                errors[d] = error
+
+    threads = []
+    for _ in range(min(jobs, len(disks))):
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+        threads.append(t)
+
+    # Join with a timeout so the main thread still receives SIGINT
+    for t in threads:
+        while t.is_alive():
+            t.join(1)
+
+    return errors
+
 
 def get_disks():
     """
@@ -155,10 +151,10 @@ def get_disks():
         disks (list): Disks
     """
     disks = []
-    cmd = "format </dev/null"
+    cmd = ["format"]
 
     try:
-        output = execute(cmd)
+        output = run(cmd).output
     except Retcode, r:
         if r.retcode != 1:
             sys.stderr.write(str(r))
@@ -181,13 +177,13 @@ def get_zpool_disks():
     Inputs:
         None
     Outputs:
-        disks (list): Disks
+        disks (DiskIndex): Disks
     """
-    disks = []
-    cmd = "zpool status"
+    disks = DiskIndex()
+    cmd = ["zpool", "status"]
 
     try:
-        output = execute(cmd)
+        output = run(cmd).output
     except Retcode, r:
         sys.stderr.write(str(r))
         sys.stderr.write(r.output)
@@ -195,7 +191,7 @@ def get_zpool_disks():
 
     for line in output.splitlines():
         if re.search(r'(c[0-9]+t.*d[0-9]+)', line):
-            disks.append(line.split()[0])
+            disks.add(line.split()[0])
 
     return disks
 
@@ -226,7 +222,9 @@ def prompt_yn(question):
 def main():
     # Parse command line arguments
     try:
-        opts, args = getopt.getopt(sys.argv[1:], ":hf", ["help", "force"])
+        opts, args = getopt.getopt(sys.argv[1:], ":hfj:c:",
+                                   ["help", "force", "jobs=",
+                                    "controller-jobs="])
     except getopt.GetoptError, err:
         sys.stderr.write(str(err))
         usage()
@@ -234,6 +232,8 @@ def main():
 
     # Initialize arguments
     force = False
+    jobs = 1
+    controller_jobs = 1
 
     for o, a in opts:
         if o in ("-h", "--help"):
@@ -241,6 +241,28 @@ def main():
             sys.exit()
         elif o in ("-f", "--force"):
             force = True
+        elif o in ("-j", "--jobs"):
+            try:
+                jobs = int(a)
+            except ValueError:
+                sys.stderr.write("The number of jobs must be an integer "
+                                 "value.\n")
+                sys.exit(1)
+            if jobs < 1:
+                sys.stderr.write("The number of jobs must be greater than "
+                                 "zero.\n")
+                sys.exit(1)
+        elif o in ("-c", "--controller-jobs"):
+            try:
+                controller_jobs = int(a)
+            except ValueError:
+                sys.stderr.write("The number of controller jobs must be an "
+                                 "integer value.\n")
+                sys.exit(1)
+            if controller_jobs < 1:
+                sys.stderr.write("The number of controller jobs must be "
+                                 "greater than zero.\n")
+                sys.exit(1)
 
     # Prompt user before continuing.
     print "THIS SCRIPT IS NOT INTENDED FOR USE ON A PRODUCTION SYSTEM. " \
@@ -255,13 +277,21 @@ def main():
     disks = get_disks()
     zpool_disks = get_zpool_disks()
 
-    # Iterate over all disks
-    for d in disks:
-        # If the disk is part of a pool continue
-        if any(d in z for z in zpool_disks):
-            continue
+    # If the disk is part of a pool skip it
+    disks = [d for d in disks if d not in zpool_disks]
+
+    errors = format_disks(disks, jobs, controller_jobs=controller_jobs)
 
-        format_disk(d)
+    # Report every failure once all the disks have been attempted
+    for d in disks:
+        if d in errors:
+            sys.stderr.write("[ERROR] Formatting %s failed\n" % d)
+            sys.stderr.write("%s\n" % errors[d].strip())
+    if errors:
+        sys.stderr.write("%d of %d disk(s) failed to format. Please review "
+                         "/var/adm/messages for additional information.\n"
+                         % (len(errors), len(disks)))
+        sys.exit(1)
 
 
 if __name__ == "__main__":
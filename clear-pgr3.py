@@ -14,9 +14,13 @@ William Kettler <william.kettler@nexenta.com>
 """
 
 import re
-import subprocess
 import getopt
 import sys
+import time
+import threading
+import Queue
+from command import run
+from inventory import DiskIndex
 
 
 def usage():
@@ -30,7 +34,7 @@ def usage():
     """
     cmd = sys.argv[0]
 
-    print "%s -r [-h] [-o OPTION]" % cmd
+    print "%s -r [-h] [-f] [-j JOBS]" % cmd
     print ""
     print "Clear PGR3 reservations from every drive in the system that is " \
           "not part of an active pool."
@@ -39,46 +43,7 @@ def usage():
     print ""
     print "    -h, --help           print usage"
     print "    -f, --force          do not prompt user"
-
-
-class Execute(Exception):
-    pass
-
-
-class Retcode(Exception):
-    pass
-
-
-def execute(cmd):
-    """
-    Execute a command in the default shell.
-
-    Inputs:
-        cmd     (str): Command to execute
-        timeout (int): Command timeout in seconds
-    Outputs:
-        output (list): STDOUT, STDERR is piped to STDOUT
-    """
-    try:
-        # Execute the command and wait for the subprocess to terminate
-        phandle = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
-                                   stderr=subprocess.STDOUT)
-        # Wait for the command to return
-        phandle.poll()
-
-        # Read the stdout/sterr buffers and retcode
-        stdout, stderr = phandle.communicate()
-        retcode = phandle.returncode
-    except Exception, e:
-        raise Execute(e)
-
-    # Split lines into list
-    if stdout and stdout is not None:
-        output = stdout.strip()
-    else:
-        output = None
-
-    return retcode, output
+    print "    -j, --jobs JOBS      clear JOBS disks concurrently"
 
 
 def get_disks():
@@ -91,16 +56,13 @@ def get_disks():
         disks (list): Disks
     """
     disks = []
-    cmd = "format </dev/null"
+    cmd = ["format"]
 
-    try:
-        retcode, output = execute(cmd)
-    except:
-        raise
-    else:
-        if retcode != 0 and retcode != 1:
-            sys.stderr.write(output)
-            sys.exit(1)
+    result = run(cmd, check=False)
+    output = result.output
+    if result.retcode != 0 and result.retcode != 1:
+        sys.stderr.write(output)
+        sys.exit(1)
 
     for line in output.splitlines():
         if re.search(r'(c[0-9]+t.*d[0-9]+\s)', line):
@@ -116,23 +78,20 @@ def get_zpool_disks():
     Inputs:
         None
     Outputs:
-        disks (list): Disks
+        disks (DiskIndex): Disks
     """
-    disks = []
-    cmd = "zpool status"
+    disks = DiskIndex()
+    cmd = ["zpool", "status"]
 
-    try:
-        retcode, output = execute(cmd)
-    except:
-        raise
-    else:
-        if retcode:
-            sys.stderr.write(output)
-            sys.exit(1)
+    result = run(cmd, check=False)
+    output = result.output
+    if result.retcode:
+        sys.stderr.write(output)
+        sys.exit(1)
 
     for line in output.splitlines():
-        if re.search(r'(c[0-9]+t.*d[0-9]+\s)', line):
-            disks.append(line.split()[0])
+        if re.search(r'(c[0-9]+t.*d[0-9]+([sp][0-9]+)?\s)', line):
+            disks.add(line.split()[0])
 
     return disks
 
@@ -144,18 +103,12 @@ def release_pgr3(d):
     Inputs:
         d (str): Device ID
     Outputs:
-        None
+        result (Result): Command result
     """
-    cmd = "/opt/HAC/RSF-1/bin/mhdc -v -d /dev/rdsk/%ss0 -c PGR3_RELEASE" % d
-
-    try:
-        retcode, output = execute(cmd)
-    except:
-        raise
+    cmd = ["/opt/HAC/RSF-1/bin/mhdc", "-v", "-d", "/dev/rdsk/%ss0" % d,
+           "-c", "PGR3_RELEASE"]
 
-    # Print output
-    if output and output is not None:
-        print output
+    return run(cmd, check=False)
 
 
 def take_pgr3(d):
@@ -165,18 +118,12 @@ def take_pgr3(d):
     Inputs:
         d (str): Drive ID
     Outputs:
-        None
+        result (Result): Command result
     """
-    cmd = "/opt/HAC/RSF-1/bin/mhdc -v -d /dev/rdsk/%ss0 -c PGR3_TAKE" % d
-
-    try:
-        retcode, output = execute(cmd)
-    except:
-        raise
+    cmd = ["/opt/HAC/RSF-1/bin/mhdc", "-v", "-d", "/dev/rdsk/%ss0" % d,
+           "-c", "PGR3_TAKE"]
 
-    # Print output
-    if output and output is not None:
-        print output
+    return run(cmd, check=False)
 
 
 def disable_failfast(d):
@@ -186,18 +133,82 @@ def disable_failfast(d):
     Inputs:
         d (str): Drive ID
     Outputs:
-        None
+        result (Result): Command result
     """
-    cmd = "/opt/HAC/RSF-1/bin/mhdc -v -d /dev/rdsk/%ss0 -c ENFAILFAST 0" % d
+    cmd = ["/opt/HAC/RSF-1/bin/mhdc", "-v", "-d", "/dev/rdsk/%ss0" % d,
+           "-c", "ENFAILFAST", "0"]
 
-    try:
-        retcode, output = execute(cmd)
-    except:
-        raise
+    return run(cmd, check=False)
+
+
+def clear_disk(d):
+    """
+    Disable failfast, then take and release the PGR3 reservation of a drive.
+
+    Inputs:
+        d (str): Drive ID
+    Outputs:
+        ok       (bool): True if every step succeeded
+        output   (list): Output of each step
+        elapsed (float): Time in seconds to clear the drive
+    """
+    ok = True
+    output = []
+    start = time.time()
 
-    # Print output
-    if output and output is not None:
-        print output
+    for step in (disable_failfast, take_pgr3, release_pgr3):
+        result = step(d)
+        if result.output.strip():
+            output.append(result.output.strip())
+        if result.retcode:
+            ok = False
+
+    return ok, output, time.time() - start
+
+
+def clear_disks(disks, jobs):
+    """
+    Clear the PGR3 reservations of many drives concurrently. Each drive's
+    steps are run in order by a single worker thread. A drive whose steps
+    raise an exception is recorded as failed with the exception as output.
+
+    Inputs:
+        disks (list): Drive IDs
+        jobs   (int): Number of worker threads
+    Outputs:
+        results (dict): clear_disk() results keyed by drive ID
+    """
+    work = Queue.Queue()
+    results = {}
+
+    for d in disks:
+        work.put(d)
+
+    def worker():
+        while True:
+            try:
+                d = work.get_nowait()
+            except Queue.Empty:
+                return
+            start = time.time()
+            try:
+                results[d] = clear_disk(d)
+            except Exception, e:
+                results[d] = (False, [str(e)], time.time() - start)
+
+    threads = []
+    for _ in range(min(jobs, len(disks))):
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+        threads.append(t)
+
+    # Join with a timeout so the main thread still receives SIGINT
+    for t in threads:
+        while t.is_alive():
+            t.join(1)
+
+    return results
 
 
 def prompt_yn(question):
@@ -226,7 +237,8 @@ def prompt_yn(question):
 def main():
     # Parse command line arguments
     try:
-        opts, args = getopt.getopt(sys.argv[1:], ":hf", ["help", "force"])
+        opts, args = getopt.getopt(sys.argv[1:], ":hfj:",
+                                   ["help", "force", "jobs="])
     except getopt.GetoptError, err:
         print str(err)
         usage()
@@ -234,6 +246,7 @@ def main():
 
     # Initialize arguments
     force = False
+    jobs = 1
 
     for o, a in opts:
         if o in ("-h", "--help"):
@@ -241,6 +254,15 @@ def main():
             sys.exit()
         elif o in ("-f", "--force"):
             force = True
+        elif o in ("-j", "--jobs"):
+            try:
+                jobs = int(a)
+            except ValueError:
+                print "The number of jobs must be an integer value."
+                sys.exit(1)
+            if jobs < 1:
+                print "The number of jobs must be greater than zero."
+                sys.exit(1)
 
     # Prompt user before continuing.
     print "RUNNING THIS SCRIPT ON A PRODUCTION SYSTEM CAN BE DANGEROUS AND " \
@@ -255,16 +277,37 @@ def main():
     disks = get_disks()
     zpool_disks = get_zpool_disks()
 
-    # Iterate over all disks
+    # If the disk is part of a pool skip it
+    disks = [d for d in disks if d not in zpool_disks]
+
+    if jobs > 1:
+        print '* Clearing %d PGR3 reservations, %d at a time.' % \
+              (len(disks), jobs)
+        results = clear_disks(disks, jobs)
+        for d in disks:
+            if results[d][0]:
+                print '* Cleared %s PGR3 reservation.' % d
+            else:
+                print '* Failed to clear %s PGR3 reservation.' % d
+            for output in results[d][1]:
+                print output
+    else:
+        results = {}
+        for d in disks:
+            print '* Clearing %s PGR3 reservation.' % d
+            results[d] = clear_disk(d)
+            for output in results[d][1]:
+                print output
+
+    # Print a summary of every disk
+    print ""
+    print "%-30s %-8s %8s" % ("DISK", "STATUS", "TIME(s)")
     for d in disks:
-        # If the disk is part of a pool continue
-        if any(d in z for z in zpool_disks):
-            continue
-
-        print '* Clearing %s PGR3 reservation.' % d
-        disable_failfast(d)
-        take_pgr3(d)
-        release_pgr3(d)
+        ok, _, elapsed = results[d]
+        print "%-30s %-8s %8.2f" % (d, "OK" if ok else "FAILED", elapsed)
+    failed = len([d for d in disks if not results[d][0]])
+    print ""
+    print "%d succeeded, %d failed." % (len(disks) - failed, failed)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,210 @@
+"""
+command.py
+
+Execute external commands. Commands are argument lists executed without a
+shell, output is read as it is produced and timeouts are enforced per command
+without signals so commands may be executed from any thread. Each command runs
+in its own session so a timeout kills any processes it started as well. The
+wall time of every command is recorded.
+
+Copyright (c) 2016  Nexenta Systems
+William Kettler <william.kettler@nexenta.com>
+"""
+
+import os
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+import collections
+
+# Number of recently executed commands to keep timings for
+history_size = 1000
+
+# Recently executed commands as (cmd, retcode, elapsed) tuples
+history = collections.deque(maxlen=history_size)
+
+
+class Timeout(Exception):
+    """
+    This exception is raised when the command exceeds the defined timeout
+    duration and the command is killed.
+    """
+    def __init__(self, cmd, timeout):
+        self.cmd = cmd
+        self.timeout = timeout
+
+    def __str__(self):
+        return "Command '%s' timed out after %d second(s)." % \
+               (" ".join(self.cmd), self.timeout)
+
+
+class Retcode(Exception):
+    """
+    This exception is raised when a command exits with a non-zero exit status.
+    """
+    def __init__(self, cmd, retcode, output=None, elapsed=None):
+        self.cmd = cmd
+        self.retcode = retcode
+        self.output = output
+        self.elapsed = elapsed
+
+    def __str__(self):
+        return "Command '%s' returned non-zero exit status %d" % \
+               (" ".join(self.cmd), self.retcode)
+
+
+class Result(object):
+    """
+    The result of a completed command.
+    """
+    def __init__(self, cmd, retcode, output, elapsed):
+        self.cmd = cmd
+        self.retcode = retcode
+        self.output = output
+        self.elapsed = elapsed
+
+
+class Command(object):
+    """
+    A command that generates its output one line at a time when iterated.
+    Once iteration completes the retcode, elapsed and errors attributes are
+    set. If iteration stops early the command is killed.
+    """
+    def __init__(self, cmd, timeout=None, merge=False):
+        """
+        Inputs:
+            cmd     (list): Command and arguments
+            timeout  (int): Command timeout in seconds
+            merge   (bool): Redirect STDERR to STDOUT
+        """
+        self.cmd = cmd
+        self.timeout = timeout
+        self.merge = merge
+        self.retcode = None
+        self.elapsed = None
+        self.errors = None
+
+    def __iter__(self):
+        start = time.time()
+        expired = threading.Event()
+        devnull = open(os.devnull)
+
+        # STDERR is spooled to a file so a chatty command can't block on a
+        # full pipe while STDOUT is being read
+        if self.merge:
+            stderr = subprocess.STDOUT
+        else:
+            stderr = tempfile.TemporaryFile(mode="w+")
+
+        try:
+            phandle = subprocess.Popen(self.cmd, stdin=devnull,
+                                       stdout=subprocess.PIPE, stderr=stderr,
+                                       close_fds=True,
+                                       universal_newlines=True,
+                                       preexec_fn=os.setsid)
+        except OSError as e:
+            devnull.close()
+            if not self.merge:
+                stderr.close()
+            # Report commands that can't be executed like the shell would
+            self.retcode = 127
+            self.elapsed = time.time() - start
+            self.errors = "%s: %s\n" % (self.cmd[0], e.strerror)
+            history.append((self.cmd, self.retcode, self.elapsed))
+            if self.merge:
+                yield self.errors
+            return
+
+        # Kill the command from a timer thread rather than SIGALRM
+        timer = None
+        if self.timeout:
+            timer = threading.Timer(self.timeout, self._expire,
+                                    [phandle, expired])
+            timer.daemon = True
+            timer.start()
+
+        try:
+            # readline() avoids the read-ahead buffering of file iteration
+            for line in iter(phandle.stdout.readline, ""):
+                yield line
+            self.retcode = phandle.wait()
+        finally:
+            if timer is not None:
+                # Wait for the timer thread so it can't outlive the program
+                timer.cancel()
+                timer.join()
+            if phandle.returncode is None:
+                self._kill(phandle)
+                phandle.wait()
+            phandle.stdout.close()
+            devnull.close()
+            self.elapsed = time.time() - start
+            history.append((self.cmd, phandle.returncode, self.elapsed))
+            if not self.merge:
+                stderr.seek(0)
+                self.errors = stderr.read()
+                stderr.close()
+
+        if expired.is_set():
+            raise Timeout(self.cmd, self.timeout)
+
+    @staticmethod
+    def _kill(phandle):
+        # Children of the command may hold STDOUT open after it exits, so the
+        # whole process group is killed
+        try:
+            os.killpg(phandle.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    @classmethod
+    def _expire(cls, phandle, expired):
+        expired.set()
+        if phandle.returncode is None:
+            cls._kill(phandle)
+
+
+def stream(cmd, timeout=None):
+    """
+    Execute a command and generate its output one line at a time as it is
+    produced. If the caller stops early the command is killed.
+
+    Inputs:
+        cmd    (list): Command and arguments
+        timeout (int): Command timeout in seconds
+    Outputs:
+        line (str): STDOUT line, generated for each line of output
+    """
+    command = Command(cmd, timeout=timeout)
+    for line in command:
+        yield line
+
+    # Raise an exception if the command exited with non-zero exit status
+    if command.retcode:
+        raise Retcode(cmd, command.retcode, output=command.errors,
+                      elapsed=command.elapsed)
+
+
+def run(cmd, timeout=None, check=True):
+    """
+    Execute a command and wait for it to complete. STDERR is redirected to
+    STDOUT.
+
+    Inputs:
+        cmd    (list): Command and arguments
+        timeout (int): Command timeout in seconds
+        check  (bool): Raise an exception on non-zero exit status
+    Outputs:
+        result (Result): Exit status, STDOUT/STDERR and wall time
+    """
+    command = Command(cmd, timeout=timeout, merge=True)
+    output = "".join(command)
+
+    # Raise an exception if the command exited with non-zero exit status
+    if check and command.retcode:
+        raise Retcode(cmd, command.retcode, output=output,
+                      elapsed=command.elapsed)
+
+    return Result(cmd, command.retcode, output, command.elapsed)
@@ -3,100 +3,49 @@
 """
 disk-info.py
 
-Print disk information in CSV format.
+Print disk information in CSV, JSON or NDJSON format.
 
 Copyright (c) 2014  Nexenta Systems
 William Kettler <william.kettler@nexenta.com>
 """
 
+import getopt
 import sys
-import signal
-import subprocess
 import re
+import threading
+import time
+from command import run, Retcode, Timeout
+from inventory import get_inventory
+from writers import formats, get_writer
 
+# Output fields
+fields = ["jbod", "slot", "devid", "size_str", "vendor", "product", "serial"]
 
-class Timeout(Exception):
-    pass
 
-
-class Execute(Exception):
-    pass
-
-
-def alarm_handler(signum, frame):
-    raise Timeout
-
-
-def execute(cmd, timeout=None):
+def usage():
     """
-    Execute a command in the default shell. If a timeout is defined the command
-    will be killed if the timeout is exceeded.
+    Print usage.
 
     Inputs:
-        cmd     (str): Command to execute
-        timeout (int): Command timeout in seconds
-    Outputs:
-        retcode  (int): Return code
-        output  (list): STDOUT/STDERR
-    """
-    # Define the timeout signal
-    if timeout:
-        signal.signal(signal.SIGALRM, alarm_handler)
-        signal.alarm(timeout)
-
-    try:
-        # Execute the command and wait for the subprocess to terminate
-        # STDERR is redirected to STDOUT
-        phandle = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
-                                   stderr=subprocess.STDOUT)
-
-        # Read the stdout/sterr buffers and retcode
-        stdout, stderr = phandle.communicate()
-        retcode = phandle.returncode
-    except Timeout, t:
-        # Kill the running process
-        phandle.kill()
-        raise Timeout("command timeout of %ds exceeded" % timeout)
-    except Exception, err:
-        raise Execute(err)
-    else:
-        # Possible race condition where alarm isn't disabled in time
-        signal.alarm(0)
-
-    # stdout may be None and we need to acct for it
-    if stdout and stdout is not None:
-        output = stdout.strip()
-    else:
-        output = None
-
-    return retcode, output
-
-
-def execute_cmd(cmd, timeout=None):
-    """
-    Execute a command as defined in the config file and write it to the SIG
-    document.
-
-    Inputs:
-        cmd     (str): Command to execute
-        timeout (int): Command timeout in seconds
+        None
     Outputs:
         None
     """
-    try:
-        retcode, output = execute(cmd, timeout=timeout)
-    except Exception, err:
-        sys.stderr.write("[ERROR] command execution failed \"%s\"\n" % cmd)
-        sys.stderr.write("[ERROR] %s\n" % str(err))
-        sys.exit(1)
-
-    # Check the command return code
-    if retcode:
-        sys.stderr.write("[ERROR] command execution failed \"%s\"\n" % cmd)
-        sys.stderr.write("[ERROR] %s\n" % output)
-        sys.exit(1)
-
-    return output
+    cmd = sys.argv[0]
+
+    print "%s [-h] [-r] [-n] [-o FORMAT]" % cmd
+    print ""
+    print "Print disk information in CSV, JSON or NDJSON format."
+    print ""
+    print "Arguments:"
+    print ""
+    print "    -h, --help           print usage"
+    print "    -r, --refresh        probe every disk rather than using the " \
+          "cached"
+    print "                         disk inventory"
+    print "    -n, --no-rescan      do not rescan the JBODs first"
+    print "    -o, --format FORMAT  output format, one of %s, defaults to " \
+          "csv" % ", ".join(formats)
 
 
 def execute_nmc(cmd, timeout=None):
@@ -108,11 +57,12 @@ def execute_nmc(cmd, timeout=None):
         cmd     (str): NMC command to execute
         timeout (int): Command timeout in seconds
     Outputs:
-        None
+        output (str): STDOUT/STDERR
     """
-    nmc = "nmc -c \"%s\"" % cmd
+    nmc = ["nmc", "-c", cmd]
     try:
-        retcode, output = execute(nmc, timeout=timeout)
+        result = run(nmc, timeout=timeout, check=False)
+        retcode, output = result.retcode, result.output.strip()
     except Exception, err:
         sys.stderr.write("[ERROR] command execution failed \"%s\"\n" % cmd)
         sys.stderr.write("[ERROR] %s\n" % str(err))
@@ -127,35 +77,23 @@ def execute_nmc(cmd, timeout=None):
     return output
 
 
-def get_hddisco():
+def get_hddisco(refresh=False):
     """
-    Return parsed hddisco output.
+    Return parsed hddisco output. The cached disk inventory is used unless a
+    refresh is requested.
 
     Inputs:
-        None
+        refresh (bool): Ignore the cached disk inventory
     Outputs:
-        hddisco (dict): Parsed hddisco output
+        hddisco (DiskIndex): Parsed hddisco output
     """
-    hddisco = {}
-
-    # Execute hddisco command
-    output = execute_cmd("hddisco", 300)
+    try:
+        return get_inventory(refresh=refresh, timeout=300)
+    except (Retcode, Timeout), e:
+        sys.stderr.write("[ERROR] command execution failed \"hddisco\"\n")
+        sys.stderr.write("[ERROR] %s\n" % (getattr(e, "output", None) or e))
+        sys.exit(1)
 
-    # Iterate over each line of stdout
-    for line in output.splitlines():
-        path = 0
-        # If the line begins with '='
-        if line.startswith("="):
-            current = line.lstrip('=').strip()
-            hddisco[current] = {}
-        # If the line begins with 'P'
-        elif line.startswith('P'):
-            continue
-        else:
-            k, v = [x.strip() for x in line.split(None, 1)]
-            hddisco[current][k] = v
-
-    return hddisco
 
 def get_slotmap():
     """
@@ -183,19 +121,116 @@ def get_slotmap():
     return slotmap
 
 
-def main():
-    execute_nmc("setup jbod rescan")
-    slotmap = get_slotmap()
-    hddisco = get_hddisco()
+def timed(name, func, *args):
+    """
+    Execute a function and print its wall time to STDERR.
+
+    Inputs:
+        name  (str): Phase name
+        func (func): Function to execute
+        args (list): Function arguments
+    Outputs:
+        result (obj): Function return value
+    """
+    start = time.time()
+    try:
+        return func(*args)
+    finally:
+        sys.stderr.write("[INFO] %s took %.1f second(s)\n"
+                         % (name, time.time() - start))
 
+
+def collect(phases):
+    """
+    Execute independent collection phases concurrently, one thread each.
+    If any phase exits the first exit is raised once all phases complete.
+
+    Inputs:
+        phases (list): (name, func, args) tuples
+    Outputs:
+        results (list): Return value of each phase in order
+    """
+    results = [None] * len(phases)
+    errors = []
+
+    def worker(i, name, func, args):
+        try:
+            results[i] = timed(name, func, *args)
+        except BaseException, e:
+            errors.append(e)
+
+    threads = []
+    for i, (name, func, args) in enumerate(phases):
+        t = threading.Thread(target=worker, args=(i, name, func, args))
+        t.daemon = True
+        t.start()
+        threads.append(t)
+
+    # Join with a timeout so SIGINT is still delivered to the main thread
+    for t in threads:
+        while t.is_alive():
+            t.join(1)
+
+    if errors:
+        raise errors[0]
+
+    return results
+
+
+def main():
+    # Define command line options
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], ":hrno:",
+                                   ["help", "refresh", "no-rescan",
+                                    "format="])
+    except getopt.GetoptError, err:
+        sys.stderr.write(str(err))
+        usage()
+        sys.exit(2)
+
+    # Initialize arguments
+    refresh = False
+    rescan = True
+    fmt = "csv"
+
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif o in ("-r", "--refresh"):
+            refresh = True
+        elif o in ("-n", "--no-rescan"):
+            rescan = False
+        elif o in ("-o", "--format"):
+            if a not in formats:
+                sys.stderr.write("The output format must be one of %s.\n"
+                                 % ", ".join(formats))
+                sys.exit(1)
+            fmt = a
+
+    start = time.time()
+    if rescan:
+        timed("jbod rescan", execute_nmc, "setup jbod rescan")
+
+    # The slotmap and hddisco don't depend on each other
+    slotmap, hddisco = collect([("slotmap", get_slotmap, []),
+                                ("hddisco", get_hddisco, [refresh])])
+    sys.stderr.write("[INFO] collection took %.1f second(s)\n"
+                     % (time.time() - start))
+
+    # The CSV output has never had a header
+    writer = get_writer(fmt, fields, header=False)
     for j in slotmap:
         for s in slotmap[j]:
             devid = slotmap[j][s]
-            print ",".join([j, str(s), devid,
-                            hddisco[devid]["size_str"],
-                            hddisco[devid]["vendor"],
-                            hddisco[devid]["product"],
-                            hddisco[devid]["serial"]])
+            disk = hddisco[devid]
+            # Fields hddisco didn't report are left empty
+            writer.write([j, s, devid,
+                          disk.size_str or "",
+                          disk.vendor or "",
+                          disk.product or "",
+                          disk.serial or ""])
+    writer.close()
 
 if __name__ == "__main__":
     main()
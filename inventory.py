@@ -0,0 +1,494 @@
+"""
+inventory.py
+
+Disk inventory shared by the disk tools. Device IDs are normalised to the
+whole disk, e.g. /dev/rdsk/c1t0d0s0 and c1t0d0p0 are both c1t0d0, so the
+same disk reported by different commands is always indexed under one key.
+
+Copyright (c) 2016  Nexenta Systems
+William Kettler <william.kettler@nexenta.com>
+"""
+
+import os
+import re
+import json
+import time
+from command import stream, Retcode
+
+# Slice or partition suffix following the disk component of a device ID
+suffix_re = re.compile(r'^(c[0-9]+.*d[0-9]+)[sp][0-9]+$')
+
+# Disk device directory listed to detect added and removed disks
+dev_dir = "/dev/rdsk"
+
+# hddisco results are cached here and each disk is re-probed once its record
+# is older than cache_ttl seconds
+cache_file = "/var/tmp/disk-inventory.json"
+cache_ttl = 3600
+
+
+def normalize(devid):
+    """
+    Return the whole disk device ID of a device path or ID.
+
+    Inputs:
+        devid (str): Device path or ID, e.g. /dev/rdsk/c1t0d0s0
+    Outputs:
+        devid (str): Device ID, e.g. c1t0d0
+    """
+    devid = os.path.basename(devid.strip())
+    m = suffix_re.match(devid)
+    if m:
+        return m.group(1)
+    return devid
+
+
+class DiskIndex(object):
+    """
+    An index of disks keyed by normalised device ID with an optional record
+    for each disk. Lookups and membership tests are O(1) and exact, so
+    c1t1d1 never matches c1t1d10.
+    """
+    def __init__(self, devids=None):
+        self.disks = {}
+        for d in devids or []:
+            self.add(d)
+
+    def add(self, devid, record=None):
+        """
+        Add a disk to the index.
+
+        Inputs:
+            devid  (str): Device path or ID
+            record (obj): Record to store for the disk
+        Outputs:
+            None
+        """
+        self.disks[normalize(devid)] = record
+
+    def get(self, devid, default=None):
+        return self.disks.get(normalize(devid), default)
+
+    def __getitem__(self, devid):
+        return self.disks[normalize(devid)]
+
+    def __contains__(self, devid):
+        return normalize(devid) in self.disks
+
+    def __iter__(self):
+        return iter(sorted(self.disks))
+
+    def __len__(self):
+        return len(self.disks)
+
+
+class Vdev(object):
+    """
+    A node in a pool's vdev tree, e.g. a mirror, raidz group or disk. Leaf
+    vdevs are disks.
+    """
+    def __init__(self, name, state=None):
+        self.name = name
+        self.state = state
+        self.children = []
+
+    def disks(self):
+        """
+        Return the device IDs of every disk beneath the vdev.
+
+        Inputs:
+            None
+        Outputs:
+            disks (list): Device IDs
+        """
+        if not self.children:
+            return [normalize(self.name)]
+
+        disks = []
+        for c in self.children:
+            disks.extend(c.disks())
+
+        return disks
+
+
+class Pool(object):
+    """
+    A pool's vdev topology. Top-level vdevs are grouped by class, i.e. data,
+    logs, cache, spares, in the order they are reported.
+    """
+    def __init__(self, name, state=None):
+        self.name = name
+        self.state = state
+        self.classes = {"data": []}
+        self.order = ["data"]
+
+    def add(self, cls, vdev):
+        if cls not in self.classes:
+            self.classes[cls] = []
+            self.order.append(cls)
+        self.classes[cls].append(vdev)
+
+    def disks(self, cls="data"):
+        """
+        Return the device IDs of every disk in a vdev class.
+
+        Inputs:
+            cls (str): Vdev class
+        Outputs:
+            disks (list): Device IDs
+        """
+        disks = []
+        for v in self.classes.get(cls, []):
+            disks.extend(v.disks())
+
+        return disks
+
+
+def parse_zpool_status(lines):
+    """
+    Parse the output of `zpool status` for any number of pools into vdev
+    trees in a single pass. The tree is built from the indentation of the
+    config section.
+
+    Inputs:
+        lines (iter): `zpool status` output lines
+    Outputs:
+        pools (list): Pools
+    """
+    pools = []
+    pool = None
+    base = None
+    stack = []
+    cls = "data"
+
+    for line in lines:
+        line = line.rstrip().expandtabs()
+        stripped = line.strip()
+
+        if stripped.startswith("pool:"):
+            pool = Pool(stripped.split(None, 1)[1])
+            pools.append(pool)
+            base = None
+            continue
+        elif pool is None or not stripped:
+            continue
+        elif stripped.startswith("NAME") and "STATE" in stripped:
+            # The config section begins after the header
+            base = -1
+            continue
+        elif stripped.startswith("errors:"):
+            base = None
+            continue
+        elif base is None:
+            continue
+
+        fields = stripped.split()
+        indent = len(line) - len(line.lstrip())
+        state = fields[1] if len(fields) > 1 else None
+
+        if base == -1:
+            # The first line of the config section is the pool itself
+            base = indent
+            pool.state = state
+            cls = "data"
+            stack = []
+            continue
+
+        if indent == base:
+            # Top-level entries other than the pool name start a new class,
+            # e.g. logs, cache or spares
+            cls = fields[0]
+            stack = []
+            continue
+
+        vdev = Vdev(fields[0], state)
+        while stack and stack[-1][0] >= indent:
+            stack.pop()
+        if stack:
+            stack[-1][1].children.append(vdev)
+        else:
+            pool.add(cls, vdev)
+        stack.append((indent, vdev))
+
+    return pools
+
+
+def get_zpool_topology(timeout=None):
+    """
+    Return the vdev topology of every imported pool from a single `zpool
+    status` invocation.
+
+    Inputs:
+        timeout (int): Command timeout in seconds
+    Outputs:
+        pools (list): Pools
+    """
+    return parse_zpool_status(stream(["zpool", "status"], timeout=timeout))
+
+
+class Disk(object):
+    """
+    The hddisco fields of a disk the tools use. Other fields are discarded
+    when the output is parsed.
+    """
+    __slots__ = ("size", "size_str", "vendor", "product", "serial")
+
+    def __init__(self, **fields):
+        for f in self.__slots__:
+            setattr(self, f, fields.get(f))
+        if self.size is not None:
+            self.size = int(self.size)
+
+    def to_dict(self):
+        return dict((f, getattr(self, f)) for f in self.__slots__)
+
+    @classmethod
+    def from_dict(cls, fields):
+        return cls(**dict((f, v) for f, v in fields.items()
+                          if f in cls.__slots__))
+
+
+def parse_hddisco(lines, fields=Disk.__slots__):
+    """
+    Parse hddisco output into a record for each disk, one line at a time.
+    Only the requested fields are kept.
+
+    Inputs:
+        lines   (iter): hddisco output lines
+        fields (tuple): Disk fields to keep
+    Outputs:
+        hddisco (DiskIndex): Parsed hddisco output
+    """
+    hddisco = DiskIndex()
+    fields = frozenset(fields)
+    current = None
+
+    for line in lines:
+        if line.startswith("="):
+            current = Disk()
+            hddisco.add(line[1:].strip(), current)
+            continue
+        elif current is None:
+            continue
+
+        kv = line.split(None, 1)
+        if len(kv) < 2 or kv[0] not in fields:
+            continue
+        elif kv[0] == "size":
+            try:
+                current.size = int(kv[1])
+            except ValueError:
+                pass
+        else:
+            setattr(current, kv[0], kv[1].strip())
+
+    return hddisco
+
+
+def hddisco(devids=None, timeout=None):
+    """
+    Execute hddisco for all disks or only the given disks. The given disks
+    are probed by a single hddisco filtered with -d. If that fails each
+    disk is probed on its own and disks hddisco can't probe are left out.
+
+    Inputs:
+        devids  (list): Device IDs, all disks if None
+        timeout  (int): Command timeout in seconds
+    Outputs:
+        hddisco (DiskIndex): Parsed hddisco output
+    """
+    if devids is None:
+        return parse_hddisco(stream(["hddisco"], timeout=timeout))
+
+    cmd = ["hddisco"]
+    for d in devids:
+        cmd.extend(["-d", d])
+    try:
+        return parse_hddisco(stream(cmd, timeout=timeout))
+    except Retcode:
+        if len(devids) == 1:
+            return DiskIndex()
+
+    disks = DiskIndex()
+    for d in devids:
+        probed = hddisco([d], timeout=timeout)
+        for devid in probed:
+            disks.add(devid, probed[devid])
+
+    return disks
+
+
+def list_devices():
+    """
+    Return the device IDs of all disks in the device directory with a
+    fingerprint of each disk. The fingerprint is the physical device path the
+    device link points to, which changes when a drive is replaced on most
+    transports. Listing the directory is cheap compared to probing the disks.
+
+    Inputs:
+        None
+    Outputs:
+        devices (dict): Fingerprints keyed by device ID, None if the
+                        directory can't be read
+    """
+    devices = {}
+    try:
+        entries = sorted(os.listdir(dev_dir))
+    except OSError:
+        return None
+
+    for e in entries:
+        devid = normalize(e)
+        if devices.get(devid) is not None:
+            continue
+        try:
+            # Strip the minor name so every slice gives the same fingerprint
+            devices[devid] = os.readlink(os.path.join(dev_dir, e)) \
+                .rsplit(":", 1)[0]
+        except OSError:
+            devices[devid] = None
+
+    return devices
+
+
+def to_dict(disk):
+    """
+    Return a disk record as a dictionary for the cache.
+
+    Inputs:
+        disk (Disk): Disk record or None
+    Outputs:
+        fields (dict): Disk fields or None
+    """
+    if disk is None:
+        return None
+    return disk.to_dict()
+
+
+def to_str(obj):
+    """
+    Convert the unicode strings json.load() returns to str, so cached
+    records have the same types as freshly probed ones.
+
+    Inputs:
+        obj (object): Decoded JSON
+    Outputs:
+        obj (object): Decoded JSON with str strings
+    """
+    if isinstance(obj, unicode):
+        return obj.encode("utf-8")
+    elif isinstance(obj, dict):
+        return dict((to_str(k), to_str(v)) for k, v in obj.iteritems())
+    elif isinstance(obj, list):
+        return [to_str(v) for v in obj]
+    return obj
+
+
+def load_cache(path):
+    """
+    Load a cached disk inventory.
+
+    Inputs:
+        path (str): Cache file
+    Outputs:
+        entries (dict): Cache entries keyed by device ID, None if the cache is
+                        missing or invalid
+    """
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+        return to_str(cache["entries"])
+    except (IOError, ValueError, KeyError, TypeError):
+        return None
+
+
+def save_cache(path, entries):
+    """
+    Save the disk inventory. The file is replaced atomically so concurrent
+    readers never see a partial inventory.
+
+    Inputs:
+        path     (str): Cache file
+        entries (dict): Cache entries keyed by device ID
+    Outputs:
+        None
+    """
+    tmp = "%s.%d" % (path, os.getpid())
+    try:
+        with open(tmp, "w") as f:
+            json.dump({"entries": entries}, f)
+        os.rename(tmp, path)
+    except (IOError, OSError):
+        # The cache is only an optimisation
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+
+
+def get_inventory(refresh=False, ttl=cache_ttl, path=cache_file,
+                  timeout=None):
+    """
+    Return the hddisco records of all disks. The cached inventory is updated
+    incrementally: only disks that appeared, whose fingerprint changed or
+    whose record is older than the TTL are probed, and disks that
+    disappeared are dropped. Every disk is probed when there is no cache or
+    a refresh is requested.
+
+    Each cache entry holds the disk's fingerprint, the time it was probed
+    and its hddisco record, or None if hddisco doesn't report the device so
+    it isn't probed again until it changes or expires.
+
+    Inputs:
+        refresh (bool): Probe every disk
+        ttl      (int): Record TTL in seconds
+        path     (str): Cache file
+        timeout  (int): hddisco timeout in seconds
+    Outputs:
+        disks (DiskIndex): Disk records
+    """
+    now = time.time()
+    entries = None if refresh else load_cache(path)
+    devices = list_devices()
+
+    if entries is None:
+        disks = hddisco(timeout=timeout)
+        entries = {}
+        for d in set(disks.disks).union(devices or []):
+            entries[d] = {"fingerprint": (devices or {}).get(d),
+                          "time": now, "record": to_dict(disks.get(d))}
+        save_cache(path, entries)
+        return disks
+
+    # Without a device listing only expired records are probed
+    if devices is None:
+        devices = dict((d, entries[d]["fingerprint"]) for d in entries)
+
+    changed = False
+    for d in set(entries).difference(devices):
+        del entries[d]
+        changed = True
+
+    probe = []
+    for d in sorted(devices):
+        e = entries.get(d)
+        if (e is None or e["fingerprint"] != devices[d] or
+                now - e["time"] > ttl):
+            probe.append(d)
+
+    if probe:
+        probed = hddisco(probe, timeout=timeout)
+        for d in probe:
+            entries[d] = {"fingerprint": devices[d], "time": now,
+                          "record": to_dict(probed.get(d))}
+        changed = True
+
+    if changed:
+        save_cache(path, entries)
+
+    disks = DiskIndex()
+    for d in entries:
+        if entries[d]["record"] is not None:
+            disks.add(d, Disk.from_dict(entries[d]["record"]))
+
+    return disks
@@ -9,166 +9,165 @@ Copyright (c) 2014  Nexenta Systems
 William Kettler <william.kettler@nexenta.com>
 """
 
+import getopt
 import sys
-import re
-import subprocess
-import signal
+from command import Retcode, Timeout
+from inventory import DiskIndex, get_inventory, get_zpool_topology
+from writers import formats, get_writer
 
+# Vdev classes reported for each pool
+classes = ["data", "logs", "cache", "spares"]
 
-class Timeout(Exception):
-    pass
+# Machine-readable output fields
+fields = ["pool", "class", "bytes"]
 
 
-def alarm_handler(signum, frame):
-    raise Timeout
-
-
-def execute(cmd, timeout=None):
+def usage():
     """
-    Execute a command in the default shell. If a timeout is defined the command
-    will be killed if the timeout is exceeded.
+    Print usage.
 
     Inputs:
-        cmd     (str): Command to execute
-        timeout (int): Command timeout in seconds
+        None
     Outputs:
-        retcode  (int): Return code
-        output  (list): STDOUT/STDERR
+        None
     """
-    # Define the timeout signal
-    if timeout:
-        signal.signal(signal.SIGALRM, alarm_handler)
-        signal.alarm(timeout)
+    cmd = sys.argv[0]
 
-    try:
-        # Execute the command and wait for the subprocess to terminate
-        # STDERR is redirected to STDOUT
-        phandle = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
-                                   stderr=subprocess.STDOUT)
-
-        # Read the stdout/sterr buffers and retcode
-        stdout, stderr = phandle.communicate()
-        retcode = phandle.returncode
-    except Timeout as t:
-        # Kill the running process
-        phandle.kill()
-        raise Timeout("command timeout of %ds exceeded" % timeout)
-    except Exception as e:
-        raise Execute(e)
-    else:
-        # Possible race condition where alarm doesn't disabled in time
-        signal.alarm(0)
-
-    # stdout may be None and we need to acct for it
-    if stdout and stdout is not None:
-        output = stdout.strip()
-    else:
-        output = None
-
-    return retcode, output
-
-
-def get_zpool_list():
+    print "%s [-h] [-r] [-o FORMAT]" % cmd
+    print ""
+    print "Display the raw capacity of all imported pools."
+    print ""
+    print "Arguments:"
+    print ""
+    print "    -h, --help           print usage"
+    print "    -r, --refresh        probe every disk rather than using the " \
+          "cached"
+    print "                         disk inventory"
+    print "    -o, --format FORMAT  output format, one of text, %s, " \
+          "defaults" % ", ".join(formats)
+    print "                         to text"
+
+
+def get_disk_sizes(refresh=False):
     """
-    Return all zpools w/the exception of syspool.
+    Return a dictionary of device IDs and their associated sizes in bytes.
 
     Inputs:
-        None
+        refresh (bool): Ignore the cached disk inventory
     Outputs:
-        zpool (list): zpools
+        sizes (DiskIndex): Device sizes
     """
-    zpool = []
-    cmd = "zpool list"
-    retcode, output = execute(cmd)
-    if retcode:
-        print "[ERROR] %s" % output
+    sizes = DiskIndex()
+    try:
+        disks = get_inventory(refresh=refresh, timeout=300)
+    except (Retcode, Timeout), e:
+        print "[ERROR] %s" % (getattr(e, "output", None) or e)
         sys.exit(1)
 
-    for line in output.splitlines():
-        # Ignore the header and syspool
-        if line.startswith("NAME") or line.startswith("syspool"):
-            continue
-        zpool.append(line.split()[0].strip())
+    for d in disks:
+        if disks[d].size is not None:
+            sizes.add(d, disks[d].size)
 
-    return zpool
+    return sizes
 
 
-def get_zpool_disks(zpool):
+def get_zpools():
     """
-    Return the device IDs for a give zpool. The list excludes any log, cache
-    or spare devices since they are not included in the capacity calculation.
+    Return the vdev topology of all zpools w/the exception of syspool. A
+    single `zpool status` is parsed for every pool.
 
     Inputs:
-        zpool (str): zpool name
+        None
     Outputs:
-        disks (list): All device IDs in the zpool
+        zpools (list): Pools
     """
-    disks = []
-    cmd = "zpool status %s" % zpool
-    retcode, output = execute(cmd)
-    if retcode:
-        print "[ERROR] %s" % output
+    try:
+        zpools = get_zpool_topology()
+    except Retcode, r:
+        print "[ERROR] %s" % r.output.strip()
         sys.exit(1)
 
-    for line in output.splitlines():
-        # Log, cache and spares aren't included in the calculation
-        if (line.strip().startswith("logs") or
-                line.strip().startswith("cache") or
-                line.strip().startswith("spares")):
-            break
-        elif re.search(r'(c[0-9]+t.*d[0-9]+\s)', line):
-            disks.append(line.split()[0])
-
-    return disks
+    return [z for z in zpools if z.name != "syspool"]
 
 
-def get_disk_sizes():
+def get_class_size(zpool, cls, disk_sizes):
     """
-    Return a dictionary of device IDs and their associated sizes in bytes.
+    Return the raw capacity of a vdev class in bytes.
 
     Inputs:
-        None
+        zpool           (Pool): zpool topology
+        cls              (str): Vdev class
+        disk_sizes (DiskIndex): Device sizes
     Outputs:
-        sizes (dict): Device sizes
+        size (int): Raw capacity in bytes
     """
-    sizes = {}
-    cmd = "hddisco"
-    retcode, output = execute(cmd)
-    if retcode:
-        print "[ERROR] %s" % output
-        sys.exit(1)
+    size = 0
+    for d in zpool.disks(cls):
+        # Disks missing from hddisco, e.g. removed devices, have no size
+        size += disk_sizes.get(d, 0)
 
-    disk = None
-    for line in output.splitlines():
-        if line.startswith("="):
-            disk = line.lstrip("=").strip()
-        elif line.startswith("size "):
-            sizes[disk] = int(line.split()[1].strip())
-
-    return sizes
+    return size
 
 
 def main():
+    # Define command line options
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], ":hro:",
+                                   ["help", "refresh", "format="])
+    except getopt.GetoptError, err:
+        sys.stderr.write(str(err))
+        usage()
+        sys.exit(2)
+
+    # Initialize arguments
+    refresh = False
+    fmt = "text"
+
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif o in ("-r", "--refresh"):
+            refresh = True
+        elif o in ("-o", "--format"):
+            if a != "text" and a not in formats:
+                sys.stderr.write("The output format must be one of text, "
+                                 "%s.\n" % ", ".join(formats))
+                sys.exit(1)
+            fmt = a
+
+    zpools = get_zpools()
+    disk_sizes = get_disk_sizes(refresh)
+
+    # Machine-readable output has a row for each vdev class of each zpool
+    if fmt != "text":
+        writer = get_writer(fmt, fields)
+        for z in zpools:
+            for cls in z.order:
+                writer.write([z.name, cls,
+                              get_class_size(z, cls, disk_sizes)])
+        writer.close()
+        return
+
     print "Calculating raw pool capacity."
-    print "NOTE log, cache, and spares are not included in the calculation."
+    print "NOTE log, cache, and spares are not included in the pool totals."
     print ""
 
     total = 0
-    zpools = get_zpool_list()
-    disk_sizes = get_disk_sizes()
 
     # Calculate raw size totals for each zpool
     for z in zpools:
-        zpool_disks = get_zpool_disks(z)
-        size = 0
-
-        # Sum the capacities of all the zpool disks
-        for d in zpool_disks:
-            size += disk_sizes[d]
-        total += size
-
-        # Print the zpool total
-        print "%20s %5.1f TB" % (z, float(size) / 1024**4)
+        sizes = {}
+        for cls in z.order:
+            sizes[cls] = get_class_size(z, cls, disk_sizes)
+        total += sizes["data"]
+
+        # Print the zpool total followed by each vdev class
+        print "%20s %5.1f TB" % (z.name, float(sizes["data"]) / 1024**4)
+        for cls in classes + [c for c in z.order if c not in classes]:
+            if cls in sizes:
+                print "%20s %5.1f TB" % (cls.upper(),
+                                         float(sizes[cls]) / 1024**4)
 
     # Print the overall total
     print "%20s %s" % (" ", "-" * 8)
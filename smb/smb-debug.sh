@@ -14,32 +14,25 @@ IFACE=$1
 DATE=$(date +%Y-%m-%d:%H:%M:%S)
 DIR="logs/${DATE}"
 IFACE=$1
-declare -a PIDS
+STATE="/var/tmp/smb-debug.json"
 
-# Gracefully exit
-trap cleanup SIGINT
-
-cleanup() {
-    for p in "${PIDS[@]}"; do
-        kill "${p}"
-    done
-    exit
-}
-
-background() {
-    $1 &
-    PIDS=("${PIDS[@]}" "$!")
-}
-
-background_log() {
-    $1 > "${DIR}/$2" &
-    PIDS=("${PIDS[@]}" "$!")
-}
+# Collector output is rotated into SEGMENT_MB or SEGMENT_SECS segments which
+# are compressed, the oldest are removed to keep the capture under BUDGET_MB
+CAPTURE="$(dirname $0)/../capture.py"
+SEGMENT_MB=100
+SEGMENT_SECS=3600
+BUDGET_MB=4096
 
 # Verify interface is defined
 if [ $# -ne 1 ]; then
     echo "Usage"
     echo -e "\t$0 interface"
+    echo ""
+    echo "Output is written to logs/DATE. To follow SMB request latency while"
+    echo "the capture runs, across its rotated segments:"
+    echo -e "\tsmb/smb-req-time.py -f logs/DATE/smb-req-time-th.out"
+    echo "To summarise the whole capture once it is stopped:"
+    echo -e "\tsmb/smb-req-time.py logs/DATE/smb-req-time-th.out.*"
     exit 1
 fi
 
@@ -57,18 +50,16 @@ echo ""
 echo "Ctrl-C to stop monitoring..."
 echo ""
 
-background "snoop -q -d ${IFACE} -o ${DIR}/${IFACE}.snoop port 445"
-# background "/usr/lib/smbsrv/dtrace/smbsrv.d -o ${DIR}/smbsrv.out"
-# background "/usr/lib/smbsrv/dtrace/smbd-authsvc.d -p `pgrep smbd` -o ${DIR}/smbd-authsvc.out"
-background_log "dtrace/smb_sessions.sh" "smb-sessions.out"
-background_log "tail -f /var/svc/log/network-smb-server:default.log" "network-smb-server.log"
-background_log "tail -f /var/svc/log/system-idmap:default.log" "system-idmap.log"
-background_log "smbstat -rzu 5" "smbstat-rzu-5.out"
-background_log "dtrace/smb_taskq_wait.d 1000" "smb-taskq-wait.out"
-background_log "dtrace/smb_kstat.d" "smb-kstat.out"
-background_log "dtrace/smb_req_time.d 1000" "smb-req-time-th.out"
-
-# Loop
-while true; do
-    read x
-done
+# The capture runs until Ctrl-C, optional collectors:
+#   "smbsrv.out=/usr/lib/smbsrv/dtrace/smbsrv.d -o {output}"
+#   "smbd-authsvc.out=/usr/lib/smbsrv/dtrace/smbd-authsvc.d -p `pgrep smbd` -o {output}"
+${CAPTURE} run -S ${STATE} -d ${DIR} -s ${SEGMENT_MB} -t ${SEGMENT_SECS} \
+    -b ${BUDGET_MB} \
+    "${IFACE}.snoop=snoop -q -d ${IFACE} -o {output} port 445" \
+    "smb-sessions.out=dtrace/smb_sessions.sh" \
+    "network-smb-server.log=tail -f /var/svc/log/network-smb-server:default.log" \
+    "system-idmap.log=tail -f /var/svc/log/system-idmap:default.log" \
+    "smbstat-rzu-5.out=smbstat -rzu 5" \
+    "smb-taskq-wait.out=dtrace/smb_taskq_wait.d 1000" \
+    "smb-kstat.out=dtrace/smb_kstat.d" \
+    "smb-req-time-th.out=dtrace/smb_req_time.d 1000"
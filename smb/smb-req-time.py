@@ -0,0 +1,407 @@
+#!/usr/bin/env python
+
+"""
+smb-req-time.py
+
+Summarise the quantize() histograms printed by dtrace/smb_req_time.d, e.g.
+smb-req-time-th.out collected by smb-debug.sh. The bucket counts of each
+command are parsed into a time series with an entry per interval, from
+which interpolated percentiles and the worst commands per interval are
+reported. The capture is parsed incrementally so a live capture can be
+followed.
+
+William Kettler <william.kettler@nexenta.com>
+Copyright 2016, Nexenta Systems, Inc.
+"""
+
+import os
+import re
+import sys
+import gzip
+import time
+import errno
+import getopt
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                ".."))
+from writers import formats, get_writer
+
+# Interval timestamp printed by the tick probe, e.g. "2016 Jan  5 10:00:00"
+stamp_re = re.compile(r'^\d{4} [A-Z][a-z]{2} +\d+ \d{2}:\d{2}:\d{2}$')
+
+# quantize() bucket row, e.g. "   1024 |@@@@@        12"
+bucket_re = re.compile(r'^\s*(-?\d+) \|[@ ]*\s+(\d+)$')
+
+# capture.py segment, e.g. "smb-req-time-th.out.00002.gz"
+segment_re = re.compile(r'^(.*)\.(\d{5})(\.gz)?$')
+
+# Percentiles reported for each command
+percentiles = [50, 90, 99, 99.9]
+
+# Output fields, the bucket counts are only included in JSON output
+fields = ["interval", "command", "count", "p50", "p90", "p99", "p999"]
+
+# Text output line format
+fmt = "%-20s %-28s %9s %10s %10s %10s %10s"
+
+
+def usage():
+    """
+    Print usage.
+
+    Inputs:
+        None
+    Outputs:
+        None
+    """
+    cmd = sys.argv[0]
+
+    print "%s [-h] [-f] [-n TOP] [-o FORMAT] FILE..." % cmd
+    print ""
+    print "Report SMB request latency percentiles per command from " \
+          "smb_req_time.d"
+    print "output. The files, e.g. the segments of a capture, are read in " \
+          "order and"
+    print "may be gzipped."
+    print ""
+    print "Arguments:"
+    print ""
+    print "    -h, --help           print usage"
+    print "    -f, --follow         follow a live capture, a single file " \
+          "or the"
+    print "                         collector output of a capture.py " \
+          "capture, e.g."
+    print "                         smb-req-time-th.out, across its segments"
+    print "    -n, --top TOP        print the TOP worst commands by p99 per " \
+          "interval,"
+    print "                         defaults to 5, all commands are exported"
+    print "    -o, --format FORMAT  export every command in FORMAT, one of " \
+          "%s" % ", ".join(formats)
+
+
+class Interval(object):
+    """
+    The latency histogram of each command in one interval. Histograms are
+    dictionaries of quantize() bucket values in usecs to non-zero counts.
+    """
+    def __init__(self, label):
+        self.label = label
+        self.commands = {}
+
+    def add(self, command, value, count):
+        if count:
+            hist = self.commands.setdefault(command, {})
+            hist[value] = hist.get(value, 0) + count
+
+
+def percentile(hist, p):
+    """
+    Return a percentile of a quantize() histogram. Bucket v holds values in
+    [v, 2v) so the percentile is interpolated linearly within its bucket.
+
+    Inputs:
+        hist (dict): Bucket values to counts
+        p   (float): Percentile, e.g. 99.9
+    Outputs:
+        value (int): Percentile in usecs
+    """
+    count = sum(hist.itervalues())
+    if not count:
+        return 0
+
+    rank = count * p / 100.0
+    seen = 0
+    for value in sorted(hist):
+        c = hist[value]
+        if seen + c >= rank:
+            if value < 1:
+                return max(value, 0)
+            return int(value + value * (rank - seen) / c)
+        seen += c
+
+    return max(hist)
+
+
+def parse(lines):
+    """
+    Parse smb_req_time.d output one line at a time. Each interval is
+    generated once the next interval begins; the last interval, including
+    the END totals, is generated when the input ends.
+
+    Inputs:
+        lines (iter): smb_req_time.d output lines
+    Outputs:
+        interval (Interval): Interval, generated for each interval
+    """
+    interval = None
+    command = None
+
+    for line in lines:
+        line = line.rstrip()
+        stripped = line.strip()
+        if not stripped:
+            continue
+
+        if stamp_re.match(stripped) or stripped == "Totals":
+            if interval is not None and interval.commands:
+                yield interval
+            interval = Interval("total" if stripped == "Totals" else
+                                time.strftime("%Y-%m-%d %H:%M:%S",
+                                              time.strptime(
+                                                  " ".join(stripped.split()),
+                                                  "%Y %b %d %H:%M:%S")))
+            command = None
+            continue
+        elif interval is None:
+            continue
+
+        m = bucket_re.match(line)
+        if m:
+            if command is not None:
+                interval.add(command, int(m.group(1)), int(m.group(2)))
+        elif line[0].isspace() and " " not in stripped:
+            # The aggregation key, i.e. the command name
+            command = stripped
+
+    if interval is not None and interval.commands:
+        yield interval
+
+
+def segments(base):
+    """
+    Return the segments capture.py has rotated a collector's output into.
+    A segment which is being compressed is returned uncompressed.
+
+    Inputs:
+        base (str): Collector output, e.g. smb-req-time-th.out
+    Outputs:
+        segments (list): Sequence number and path of each segment, oldest
+                         first
+    """
+    directory = os.path.dirname(base)
+    name = os.path.basename(base)
+    found = {}
+    for f in os.listdir(directory or "."):
+        m = segment_re.match(f)
+        if m and m.group(1) == name:
+            seq = int(m.group(2))
+            if seq not in found or not m.group(3):
+                found[seq] = os.path.join(directory, f)
+    return sorted(found.items())
+
+
+def open_file(path):
+    """
+    Open a file, decompressing segments compressed by capture.py.
+
+    Inputs:
+        path (str): File
+    Outputs:
+        fhandle (file): Open file
+    """
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    return open(path)
+
+
+def follow(path, poll=1):
+    """
+    Generate the lines of a file as they are written, like `tail -f`.
+    Partial lines are held until they are complete.
+
+    The output of a capture.py collector is followed across segments, so
+    either a segment or the collector output name, e.g.
+    smb-req-time-th.out for the latest segment, may be given. Once the
+    segment stops growing and a newer segment exists the rest of the
+    segment is read and the next segment is followed.
+
+    Inputs:
+        path (str): File, segment or collector output
+        poll (int): Seconds to wait for more data at the end of the file
+    Outputs:
+        line (str): Line, generated for each line
+    """
+    m = segment_re.match(path)
+    if m:
+        base, seq = m.group(1), int(m.group(2))
+    else:
+        base, seq = path, None
+        if not os.path.exists(path):
+            found = segments(base)
+            if found:
+                seq, path = found[-1]
+
+    fhandle = open_file(path)
+    partial = ""
+    pending = None
+    try:
+        while True:
+            line = fhandle.readline()
+            if line:
+                partial += line
+                if partial.endswith("\n"):
+                    yield partial
+                    partial = ""
+                continue
+
+            if pending is not None:
+                # The rest of the segment has been read. The next segment
+                # may be compressed before it is opened, so it is looked up
+                # again.
+                path = dict(segments(base)).get(pending)
+                next_seq, pending = pending, None
+                if path is None:
+                    continue
+                try:
+                    next_handle = open_file(path)
+                except IOError, e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                    continue
+                fhandle.close()
+                fhandle = next_handle
+                seq = next_seq
+                continue
+
+            if seq is not None:
+                newer = [s for s, p in segments(base) if s > seq]
+                if newer:
+                    # Segments removed to stay within budget are skipped
+                    pending = newer[0]
+                    continue
+
+            time.sleep(poll)
+    finally:
+        fhandle.close()
+
+
+def read_lines(paths):
+    """
+    Generate the lines of each file in turn, decompressing segments
+    compressed by capture.py.
+
+    Inputs:
+        paths (list): Files
+    Outputs:
+        line (str): Line, generated for each line
+    """
+    for path in paths:
+        fhandle = open_file(path)
+        try:
+            for line in fhandle:
+                yield line
+        finally:
+            fhandle.close()
+
+
+def rows(interval):
+    """
+    Generate a row per command with its percentiles and bucket counts.
+
+    Inputs:
+        interval (Interval): Interval
+    Outputs:
+        row (list): Row, generated for each command
+    """
+    for command in sorted(interval.commands):
+        hist = interval.commands[command]
+        yield ([interval.label, command, sum(hist.itervalues())] +
+               [percentile(hist, p) for p in percentiles] + [hist])
+
+
+def report(interval, top):
+    """
+    Print the worst commands of an interval by p99.
+
+    Inputs:
+        interval (Interval): Interval
+        top           (int): Number of commands to print
+    Outputs:
+        None
+    """
+    worst = sorted(rows(interval), key=lambda r: (r[5], r[2]), reverse=True)
+    for row in worst[:top]:
+        print fmt % tuple(row[:7])
+    sys.stdout.flush()
+
+
+def main():
+    # Define command line options
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], ":hfn:o:",
+                                   ["help", "follow", "top=", "format="])
+    except getopt.GetoptError, err:
+        sys.stderr.write(str(err))
+        usage()
+        sys.exit(2)
+
+    # Initialize arguments
+    tail = False
+    top = 5
+    fmt_out = None
+
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif o in ("-f", "--follow"):
+            tail = True
+        elif o in ("-n", "--top"):
+            try:
+                top = int(a)
+            except ValueError:
+                top = 0
+            if top < 1:
+                sys.stderr.write("TOP must be an integer greater than "
+                                 "zero.\n")
+                sys.exit(1)
+        elif o in ("-o", "--format"):
+            if a not in formats:
+                sys.stderr.write("The output format must be one of %s.\n"
+                                 % ", ".join(formats))
+                sys.exit(1)
+            fmt_out = a
+
+    if not args or (tail and len(args) != 1):
+        usage()
+        sys.exit(2)
+
+    if tail:
+        lines = follow(args[0])
+    else:
+        lines = read_lines(args)
+
+    writer = None
+    if fmt_out is not None:
+        # Only JSON can hold the bucket counts
+        export = fields + (["buckets"] if fmt_out != "csv" else [])
+        writer = get_writer(fmt_out, export)
+    else:
+        print fmt % ("INTERVAL", "COMMAND", "COUNT", "P50(us)", "P90(us)",
+                     "P99(us)", "P999(us)")
+
+    try:
+        for interval in parse(lines):
+            if writer is None:
+                report(interval, top)
+                continue
+            for row in rows(interval):
+                if fmt_out == "csv":
+                    row = row[:-1]
+                else:
+                    # JSON object keys must be strings
+                    row[-1] = dict((str(k), v) for k, v in row[-1].items())
+                writer.write(row)
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+    except IOError, e:
+        sys.stderr.write("[ERROR] %s\n" % e)
+        sys.exit(1)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -11,18 +11,44 @@ William Kettler <william.kettler@nexenta.com>
 
 import syslog
 import datetime
-import subprocess
-import signal
 import getopt
 import sys
+import os
+import re
+import fnmatch
+import ConfigParser
+from command import run, stream, Retcode
 import time
+import threading
+import Queue
 
 # Minimum allowable retention definition
 min_retention = 7
 
+# Policy file retention tiers and the strftime format of their buckets
+tiers = [
+    ("hourly", "%Y%m%d%H"),
+    ("daily", "%Y%m%d"),
+    ("weekly", "%Y%W"),
+    ("monthly", "%Y%m")
+]
+
+# Run journal and the number of records written between fsyncs
+journal_file = "/var/tmp/snap-retention.journal"
+journal_sync = 100
+
+# zfs destroy errors reported for snapshots that no longer exist
+missing_re = re.compile(r"could not find any snapshots to destroy|"
+                        r"dataset does not exist")
+
+# Adaptive throttle pause bounds in seconds
+throttle_step = 0.25
+throttle_max = 60
+
 # Logger
 log_level = "INFO"
 syslog.openlog("snap-retention", 0, syslog.LOG_LOCAL0)
+log_lock = threading.Lock()
 
 
 def usage():
@@ -36,7 +62,11 @@ def usage():
     """
     cmd = sys.argv[0]
 
-    print "%s [-hfyt] [-p PAUSE] -r DAYS -s SEARCH " % cmd
+    print "%s [-hfyt] [-p PAUSE] [-a MS] [-b SIZE] [-j JOBS [-P JOBS] [-T]] " \
+          "[-D DATASET]... -r DAYS -s SEARCH " % cmd
+    print "%s [-hfyt] [OPTION]... -c POLICY" % cmd
+    print "%s [-hfyt] [OPTION]... -R" % cmd
+    print "%s --report" % cmd
     print ""
     print "Apply a snapshot retention policy."
     print ""
@@ -46,11 +76,34 @@ def usage():
     print "    -r, --retention DAYS     Retention policy in days"
     print "    -s, --search SEARCH      Search string will match snapshot"
     print "                             names, e.g. -s AutoSync"
+    print "    -c, --config POLICY      Apply the retention rules defined in"
+    print "                             the POLICY file instead of -r and -s"
+    print "    -D, --dataset DATASET    Only list snapshots of DATASET and its"
+    print "                             descendants, may be repeated"
     print "    -f, --force              Force destroy"
     print "    -p, --pause              Time in seconds to sleep between"
     print "                             destroy commands"
+    print "    -a, --adaptive MS        Adapt the pause to keep destroy"
+    print "                             latency below MS milliseconds, the"
+    print "                             pause duration is the initial pause"
+    print "    -b, --batch SIZE         Destroy up to SIZE snapshots of a"
+    print "                             dataset with a single command"
+    print "    -j, --jobs JOBS          Destroy snapshots from JOBS worker"
+    print "                             threads in parallel"
+    print "    -P, --pool-jobs JOBS     Max concurrent workers per pool,"
+    print "                             defaults to 1, requires -T as a pool"
+    print "                             is a single partition otherwise"
+    print "    -T, --top-level          Partition work by top-level dataset"
+    print "                             instead of by pool"
     print "    -y, --yes                Automatically answer yes to prompts"
-    print "    -t  --test               Test mode"
+    print "    -t  --test               Test mode, estimates the space each"
+    print "                             dataset would reclaim"
+    print "    -R, --resume             Resume the last run from the journal"
+    print "                             instead of listing snapshots"
+    print "    --journal FILE           Journal file, defaults to"
+    print "                             %s" % journal_file
+    print "    --report                 Print the throughput of each run in"
+    print "                             the journal"
 
 
 def logger(level, msg, stdout=True):
@@ -71,11 +124,12 @@ def logger(level, msg, stdout=True):
         "ERROR": syslog.LOG_ERR
     }
 
-    if levels[level] <= levels[log_level] and stdout:
-        now = str(datetime.datetime.now())
-        print "%s [%s] %s" % (now, level, msg)
+    with log_lock:
+        if levels[level] <= levels[log_level] and stdout:
+            now = str(datetime.datetime.now())
+            print "%s [%s] %s" % (now, level, msg)
 
-    syslog.syslog(levels[level], msg)
+        syslog.syslog(levels[level], msg)
 
 
 def prompt_yn(question):
@@ -101,135 +155,312 @@ def prompt_yn(question):
     return answer
 
 
-class Signal(Exception):
+def get_pools():
     """
-    This exception is raise by the signal handler.
+    Return all imported pools w/the exception of syspool.
+
+    Inputs:
+        None
+    Outputs:
+        pools (list): Pool names
     """
-    pass
+    cmd = ["zpool", "list", "-H", "-o", "name"]
+    try:
+        output = run(cmd).output
+    except Retcode, r:
+        logger("ERROR", str(r))
+        logger("ERROR", r.output)
+        sys.exit(1)
+    except Exception, e:
+        logger("ERROR", str(e))
+        sys.exit(1)
+
+    return [p for p in output.split() if p != "syspool"]
 
 
-class Timeout(Exception):
+def get_roots(datasets=None, patterns=None):
     """
-    This exception is raised when the command exceeds the defined timeout
-    duration and the command is killed.
+    Return the datasets snapshot enumeration should be scoped to. If no
+    datasets are defined, use the pools named at the start of the policy
+    dataset patterns if every pattern names one, otherwise every pool except
+    syspool. The search string matches anywhere in a snapshot name so it
+    never scopes the listing.
+
+    Inputs:
+        datasets (list): Datasets defined on the command line
+        patterns (list): Policy dataset patterns
+    Outputs:
+        roots (list): Dataset names
     """
-    def __init__(self, cmd, timeout):
-        self.cmd = cmd
-        self.timeout = timeout
+    if datasets:
+        return datasets
 
-    def __str__(self):
-        return "Command '%s' timed out after %d second(s)." % \
-               (self.cmd, self.timeout)
+    pools = get_pools()
+    if not patterns:
+        return pools
 
+    roots = []
+    for pattern in patterns:
+        named = [p for p in pools if pattern == p or
+                 pattern.startswith(p + "/") or pattern.startswith(p + "@")]
+        if not named:
+            return pools
+        if named[0] not in roots:
+            roots.append(named[0])
 
-class Retcode(Exception):
-    """
-    This exception is raise when a command exits with a non-zero exit status.
-    """
-    def __init__(self, cmd, retcode, output=None):
-        self.cmd = cmd
-        self.retcode = retcode
-        self.output = output
+    return roots
 
-    def __str__(self):
-        return "Command '%s' returned non-zero exit status %d" % \
-               (self.cmd, self.retcode)
 
+def get_snaps(roots, cutoff=None):
+    """
+    Generate the ZFS snapshots beneath each root dataset as they are listed.
+    Each root is listed oldest first, so when a cutoff date is defined the
+    listing stops at the first snapshot created after it.
 
-def alarm_handler(signum, frame):
-    raise Signal
+    Inputs:
+        roots      (list): Dataset names
+        cutoff (datetime): Cutoff date
+    Outputs:
+        snap (tuple): Snapshot name, creation time and used bytes, generated
+                      for each snapshot
+    """
+    for root in roots:
+        cmd = ["zfs", "list", "-H", "-p", "-o", "name,creation,used", "-t",
+               "snapshot", "-r", "-s", "creation", root]
+        lines = stream(cmd)
+        try:
+            for l in lines:
+                name, creation, used = l.rstrip("\n").split("\t")
+                if cutoff is not None and \
+                        datetime.datetime.fromtimestamp(int(creation)) > cutoff:
+                    logger("DEBUG", "Stopping %s listing at %s, does not meet "
+                           "retention policy" % (root, name))
+                    break
+                yield name, creation, used
+        except Retcode, r:
+            logger("ERROR", str(r))
+            logger("ERROR", r.output)
+            sys.exit(1)
+        except Exception, e:
+            logger("ERROR", str(e))
+            sys.exit(1)
+        finally:
+            lines.close()
 
 
-def execute(cmd, timeout=None):
+def get_expired(snaps, search, cutoff):
     """
-    Execute a command in the default shell. If a timeout is defined the command
-    will be killed if the timeout is exceeded and an exception will be raised.
+    Filter snapshots down to those that match the search string and were
+    created before the cutoff date. syspool snapshots are always skipped.
 
     Inputs:
-        cmd     (str): Command to execute
-        timeout (int): Command timeout in seconds
+        snaps      (iter): Snapshot names, creation times and used bytes
+        search      (str): Search string
+        cutoff (datetime): Cutoff date
     Outputs:
-        output (str): STDOUT/STDERR
+        snap (tuple): Snapshot name and used bytes, generated for each
+                      expired snapshot
     """
-    # Define the timeout signal
-    if timeout:
-        signal.signal(signal.SIGALRM, alarm_handler)
-        signal.alarm(timeout)
+    for snap, creation, used in snaps:
+        # Skip syspool snapshots
+        if snap.startswith("syspool"):
+            logger("DEBUG", "Skipping syspool snapshot %s" % snap)
+            continue
 
-    try:
-        # Execute the command and wait for the subprocess to terminate
-        # STDERR is redirected to STDOUT
-        phandle = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
-                                   stderr=subprocess.STDOUT)
-
-        # Read the stdout/sterr buffers and retcode
-        output, _ = phandle.communicate()
-        retcode = phandle.poll()
-    except Signal:
-        # Kill the running process
-        phandle.kill()
-        raise Timeout(cmd=cmd, timeout=timeout)
-    except:
-        logger.debug("Unhandled exception", exc_info=True)
-        raise
-    else:
-        # Possible race condition where alarm isn't disabled in time
-        signal.alarm(0)
+        # Skip snapshots that don't containt the search string
+        if search is not None and search not in snap:
+            logger("DEBUG", "Skipping %s, does not contain search string"
+                   % snap)
+            continue
 
-    # Raise an exception if the command exited with non-zero exit status
-    if retcode:
-        raise Retcode(cmd, retcode, output=output)
+        # Skip snapshots that don't meet the retention policy
+        if datetime.datetime.fromtimestamp(int(creation)) > cutoff:
+            logger("DEBUG", "Skipping %s, does not meet retention policy"
+                   % snap)
+            continue
 
-    return output
+        yield snap, int(used)
 
 
-def get_snaps():
+class Rule(object):
     """
-    Return a list of ZFS snapshots.
+    A policy file retention rule. Snapshots of datasets matching the dataset
+    pattern and named after the snapshot pattern keep the newest snapshot of
+    each of the most recent N hours, days, weeks and months.
+    """
+    def __init__(self, name, dataset, snapshot, keep):
+        self.name = name
+        self.dataset = dataset
+        self.snapshot = snapshot
+        self.keep = keep
+
+    def __str__(self):
+        return "%s dataset=%s snapshot=%s %s" % \
+               (self.name, self.dataset, self.snapshot,
+                " ".join("%s=%d" % (t, self.keep[t]) for t, _ in tiers))
+
+
+def read_policy(path):
+    """
+    Parse a policy file. Each section defines a rule, rules are evaluated in
+    the order they are defined and the first matching rule applies.
+
+        [autosync]
+        dataset = tank/*
+        snapshot = AutoSync-*
+        hourly = 24
+        daily = 7
+        weekly = 4
+        monthly = 12
 
     Inputs:
-        None
+        path (str): Policy file
     Outputs:
-        snaps (list): A list of snapshots and creation times
+        rules (list): Rules
     """
-    snaps = []
+    rules = []
+    config = ConfigParser.RawConfigParser()
 
-    cmd = "zfs get -pt snapshot creation"
     try:
-        output = execute(cmd)
-    except Retcode, r:
-        logger("ERROR", str(r))
-        logger("ERROR", r.output)
+        if not config.read(path):
+            logger("ERROR", "Unable to read policy %s" % path)
+            sys.exit(1)
+        for section in config.sections():
+            keep = {}
+            for t, _ in tiers:
+                if config.has_option(section, t):
+                    keep[t] = config.getint(section, t)
+                else:
+                    keep[t] = 0
+            snapshot = "*"
+            if config.has_option(section, "snapshot"):
+                snapshot = config.get(section, "snapshot")
+            rules.append(Rule(section, config.get(section, "dataset"),
+                              snapshot, keep))
+    except (ConfigParser.Error, ValueError), e:
+        logger("ERROR", "Invalid policy %s: %s" % (path, str(e)))
         sys.exit(1)
-    except Exception, e:
-        logger("ERROR", str(e))
+
+    if not rules:
+        logger("ERROR", "Policy %s does not define any rules" % path)
         sys.exit(1)
 
-    for l in output.splitlines()[1:]:
-        name, _, creation, _ = l.split()
-        snaps.append((name, creation))
+    return rules
+
+
+def match_rules(dataset, rules):
+    """
+    Return a regex that matches the snapshot names of every rule applying to
+    the dataset. Each rule is a named group so a single match per snapshot
+    identifies the first matching rule.
+
+    Inputs:
+        dataset (str): Dataset name
+        rules  (list): Rules
+    Outputs:
+        regex (SRE_Pattern): Compiled regex, None if no rules apply
+    """
+    groups = []
+    for i, r in enumerate(rules):
+        if fnmatch.fnmatchcase(dataset, r.dataset):
+            # fnmatch.translate() appends \Z with global inline flags
+            groups.append("(?P<r%d>%s)" % (i, fnmatch.translate(r.snapshot)))
+
+    if not groups:
+        return None
+
+    return re.compile("|".join(groups))
+
+
+def get_policy_expired(snaps, rules, cutoff):
+    """
+    Evaluate every rule against a single snapshot enumeration. Snapshots are
+    indexed by dataset and rule as they are listed, each dataset is matched
+    against the rules once and each snapshot name once, so planning scales
+    with the number of snapshots rather than snapshots times rules. Snapshots
+    created after the cutoff date are always kept.
+
+    Inputs:
+        snaps      (iter): Snapshot names, creation times and used bytes
+        rules      (list): Rules
+        cutoff (datetime): Cutoff date
+    Outputs:
+        snap (tuple): Snapshot name and used bytes, generated for each
+                      expired snapshot
+    """
+    # Snapshots oldest first keyed by dataset and rule index
+    index = {}
+    regexes = {}
+
+    for snap, creation, used in snaps:
+        if snap.startswith("syspool"):
+            logger("DEBUG", "Skipping syspool snapshot %s" % snap)
+            continue
+
+        dataset, name = snap.split("@", 1)
+        if dataset not in regexes:
+            regexes[dataset] = match_rules(dataset, rules)
+        m = regexes[dataset] and regexes[dataset].match(name)
+        if not m:
+            logger("DEBUG", "Skipping %s, does not match a rule" % snap)
+            continue
+
+        rule = int(m.lastgroup[1:])
+        index.setdefault(dataset, {}).setdefault(rule, []).append(
+            (int(creation), snap, int(used)))
+
+    for dataset in sorted(index):
+        for rule in sorted(index[dataset]):
+            keep = rules[rule].keep
+            buckets = dict((t, set()) for t, _ in tiers)
+            expired = []
+
+            # Keep the newest snapshot in each of the most recent buckets
+            for creation, snap, used in reversed(index[dataset][rule]):
+                date = datetime.datetime.fromtimestamp(creation)
+                kept = False
+                for t, fmt in tiers:
+                    b = date.strftime(fmt)
+                    if b not in buckets[t] and len(buckets[t]) < keep[t]:
+                        buckets[t].add(b)
+                        kept = True
+                if kept:
+                    logger("DEBUG", "Keeping %s, retained by rule %s"
+                           % (snap, rules[rule].name))
+                elif date > cutoff:
+                    logger("DEBUG", "Keeping %s, does not meet min retention "
+                           "policy" % snap)
+                else:
+                    expired.append((snap, used))
 
-    return snaps
+            for snap, used in reversed(expired):
+                yield snap, used
 
 
-def destroy_snap(snap, force=False):
+def destroy_snap(snap, force=False, missing=False):
     """
     Destroy a ZFS snapshot.
 
     Inputs:
-        snap   (str): Snapshot name
-        force (bool): Force destroy
+        snap     (str): Snapshot name
+        force   (bool): Force destroy
+        missing (bool): Treat a snapshot that no longer exists as destroyed
     Outputs:
         None
     """
     if force:
-        cmd = "zfs destroy -f %s" % snap
+        cmd = ["zfs", "destroy", "-f", snap]
     else:
-        cmd = "zfs destroy %s" % snap
+        cmd = ["zfs", "destroy", snap]
 
     try:
-        execute(cmd)
+        result = run(cmd)
+        logger("DEBUG", "Command '%s' completed in %.2f seconds"
+               % (" ".join(cmd), result.elapsed))
     except Retcode, r:
+        if missing and missing_re.search(r.output or ""):
+            logger("WARN", "%s no longer exists" % snap)
+            return
         logger("ERROR", str(r))
         logger("ERROR", r.output)
         sys.exit(1)
@@ -238,6 +469,689 @@ def destroy_snap(snap, force=False):
         sys.exit(1)
 
 
+def destroy_snaps(dataset, snaps, force=False, missing=False):
+    """
+    Destroy multiple snapshots of a single dataset with one command using the
+    ZFS comma separated snapshot syntax, e.g. pool/fs@snap1,snap2,snap3.
+    Snapshots in the list that no longer exist are skipped by zfs as long as
+    one of them exists.
+
+    Inputs:
+        dataset  (str): Dataset name
+        snaps   (list): Snapshot names without the dataset component
+        force   (bool): Force destroy
+        missing (bool): Treat snapshots that no longer exist as destroyed
+    Outputs:
+        None
+    """
+    destroy_snap("%s@%s" % (dataset, ",".join(snaps)), force=force,
+                 missing=missing)
+
+
+def get_ranges(dataset, snaps):
+    """
+    Collapse snapshots of a single dataset into contiguous ranges using the
+    ZFS snapshot range syntax, e.g. snap1%snap5,snap8, so the whole set fits
+    on one command line. Snapshots are ordered by createtxg like zfs orders
+    a range.
+
+    Inputs:
+        dataset (str): Dataset name
+        snaps  (list): Snapshot names without the dataset component
+    Outputs:
+        ranges (list): Snapshot names and first%last ranges
+    """
+    cmd = ["zfs", "list", "-H", "-o", "name", "-t", "snapshot", "-d", "1",
+           "-s", "createtxg", dataset]
+    planned = set(snaps)
+    ranges = []
+    first = last = None
+    for l in stream(cmd):
+        name = l.rstrip("\n").split("@", 1)[1]
+        if name in planned:
+            if first is None:
+                first = name
+            last = name
+            continue
+        if first is not None:
+            ranges.append(first if first == last else
+                          "%s%%%s" % (first, last))
+            first = None
+    if first is not None:
+        ranges.append(first if first == last else "%s%%%s" % (first, last))
+
+    return ranges
+
+
+def estimate_snaps(dataset, snaps):
+    """
+    Estimate the space reclaimed by destroying every planned snapshot of a
+    single dataset together with one dry run destroy, so blocks shared by
+    the planned snapshots are counted.
+
+    Inputs:
+        dataset (str): Dataset name
+        snaps  (list): Snapshot names without the dataset component
+    Outputs:
+        reclaim (int): Bytes reclaimed, 0 if it can't be estimated
+    """
+    try:
+        ranges = get_ranges(dataset, snaps)
+        if not ranges:
+            logger("WARN", "No planned snapshots of %s exist" % dataset)
+            return 0
+        cmd = ["zfs", "destroy", "-nvp", "%s@%s" % (dataset,
+                                                   ",".join(ranges))]
+        output = run(cmd).output
+    except Retcode, r:
+        logger("WARN", str(r))
+        logger("WARN", r.output)
+        return 0
+    except Exception, e:
+        logger("WARN", str(e))
+        return 0
+
+    for line in output.splitlines():
+        if line.startswith("reclaim"):
+            return int(line.split()[1])
+
+    return 0
+
+
+def get_freeing(pool):
+    """
+    Return the number of bytes the pool has yet to free in the background.
+
+    Inputs:
+        pool (str): Pool name
+    Outputs:
+        freeing (int): Bytes pending free, None if it can't be determined
+    """
+    cmd = ["zpool", "get", "-Hp", "freeing", pool]
+    try:
+        output = run(cmd).output
+        return int(output.split("\t")[2])
+    except Exception, e:
+        logger("DEBUG", "Unable to get %s freeing: %s" % (pool, str(e)))
+        return None
+
+
+class Throttle(object):
+    """
+    Adaptive pacing between destroy commands. A zfs destroy waits for the
+    pool to sync a txg, so the command latency is used as a measure of how
+    loaded the pool is. The target applies to destroying a single snapshot,
+    so the latency of a batched destroy is divided by the batch size. The
+    pause is doubled whenever latency exceeds the target and halved while
+    latency is below the target and the pool has no pending-free backlog.
+    Each pool is paced independently.
+    """
+    def __init__(self, target, pause=0):
+        self.target = target
+        self.initial = pause
+        self.pauses = {}
+        self.lock = threading.Lock()
+
+    def update(self, pool, latency, count=1):
+        """
+        Record the latency of a destroy command and return the time to
+        pause before the next one.
+
+        Inputs:
+            pool      (str): Pool name
+            latency (float): Destroy command latency in seconds
+            count     (int): Snapshots destroyed by the command
+        Outputs:
+            pause (float): Time in seconds to sleep
+        """
+        freeing = get_freeing(pool)
+        per_snap = latency / max(count, 1)
+
+        with self.lock:
+            pause = self.pauses.get(pool, self.initial)
+            if per_snap > self.target:
+                decision = "backing off"
+                pause = min(max(pause * 2, throttle_step), throttle_max)
+            elif freeing:
+                decision = "holding"
+            else:
+                decision = "speeding up"
+                pause = pause / 2.0
+                if pause < throttle_step:
+                    pause = 0
+            self.pauses[pool] = pause
+
+        logger("INFO", "Throttle %s latency=%.3fs snapshots=%d "
+               "per_snapshot=%.3fs target=%.3fs freeing=%s, %s, pause=%.2fs"
+               % (pool, latency, count, per_snap, self.target, freeing,
+                  decision, pause))
+
+        return pause
+
+
+def pace(dataset, latency, pause=0, throttle=None, count=1):
+    """
+    Sleep between destroy commands.
+
+    Inputs:
+        dataset       (str): Dataset the last destroy command operated on
+        latency     (float): Last destroy command latency in seconds
+        pause         (int): Time in seconds to sleep
+        throttle (Throttle): Adaptive throttle, overrides pause if defined
+        count         (int): Snapshots destroyed by the last command
+    Outputs:
+        None
+    """
+    if throttle is not None:
+        pause = throttle.update(dataset.split("/")[0], latency, count)
+
+    logger("INFO", "Sleeping for %s" % pause)
+    time.sleep(pause)
+
+
+class Journal(object):
+    """
+    Append-only record of the snapshots planned for destruction and those
+    destroyed, used to resume an interrupted run and to report throughput.
+    Each record is a tab separated line of one of the following forms.
+
+        RUN <time> <new|resume>
+        PLAN <snapshot> <used>
+        PLANNED <time>
+        DONE <snapshot> <used> <time>
+        END <time>
+
+    END is only written by a run that completes, so a run without one was
+    interrupted or failed. Records are fsync'ed in batches of journal_sync,
+    so a crash can lose the last records and tear the last line. Malformed
+    records are skipped when the journal is read.
+    """
+    def __init__(self, path):
+        self.path = path
+
+        # A record torn by a crash must not run into the first new record
+        torn = False
+        try:
+            with open(path) as f:
+                f.seek(-1, os.SEEK_END)
+                torn = f.read(1) != "\n"
+        except IOError:
+            pass
+
+        self.fhandle = open(path, "a")
+        if torn:
+            self.fhandle.write("\n")
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    def write(self, *fields):
+        """
+        Append a record to the journal.
+
+        Inputs:
+            fields (list): Record fields
+        Outputs:
+            None
+        """
+        with self.lock:
+            self.fhandle.write("%s\n" % "\t".join(str(f) for f in fields))
+            self.pending += 1
+            if self.pending >= journal_sync:
+                self.sync()
+
+    def sync(self):
+        """
+        Flush pending records to stable storage.
+
+        Inputs:
+            None
+        Outputs:
+            None
+        """
+        self.fhandle.flush()
+        os.fsync(self.fhandle.fileno())
+        self.pending = 0
+
+    def start(self, resume=False):
+        """
+        Record the start of a run.
+
+        Inputs:
+            resume (bool): The run resumes the previous run
+        Outputs:
+            None
+        """
+        self.write("RUN", time.time(), "resume" if resume else "new")
+
+    def plan(self, snaps):
+        """
+        Record each planned snapshot as it is generated.
+
+        Inputs:
+            snaps (iter): Snapshot names and used bytes
+        Outputs:
+            snap (tuple): Snapshot name and used bytes, generated for each
+                          snapshot
+        """
+        for snap, used in snaps:
+            self.write("PLAN", snap, used)
+            yield snap, used
+        self.write("PLANNED", time.time())
+
+    def done(self, snap, used):
+        """
+        Record a destroyed snapshot.
+
+        Inputs:
+            snap (str): Snapshot name
+            used (int): Used bytes
+        Outputs:
+            None
+        """
+        self.write("DONE", snap, used, time.time())
+
+    def close(self, completed=True):
+        """
+        Record the end of the run, if it completed, and close the journal.
+
+        Inputs:
+            completed (bool): The run completed
+        Outputs:
+            None
+        """
+        if completed:
+            self.write("END", time.time())
+        with self.lock:
+            self.sync()
+            self.fhandle.close()
+
+
+def read_journal(path):
+    """
+    Parse the journal into runs.
+
+    Inputs:
+        path (str): Journal file
+    Outputs:
+        runs (list): A dict for each run
+    """
+    runs = []
+
+    try:
+        fhandle = open(path)
+    except IOError, e:
+        logger("ERROR", "Unable to open journal: %s" % str(e))
+        sys.exit(1)
+
+    for line in fhandle:
+        fields = line.rstrip("\n").split("\t")
+        try:
+            if fields[0] == "RUN":
+                entry = {
+                    "start": float(fields[1]),
+                    "type": fields[2],
+                    "plan": [],
+                    "planned": False,
+                    "done": set(),
+                    "size": 0,
+                    "last": float(fields[1]),
+                    "end": None
+                }
+                runs.append(entry)
+            elif not runs:
+                continue
+            elif fields[0] == "PLAN":
+                entry["plan"].append((fields[1], int(fields[2])))
+            elif fields[0] == "PLANNED":
+                entry["planned"] = True
+            elif fields[0] == "DONE":
+                used, last = int(fields[2]), float(fields[3])
+                entry["done"].add(fields[1])
+                entry["size"] += used
+                entry["last"] = last
+            elif fields[0] == "END":
+                entry["end"] = float(fields[1])
+        except (IndexError, ValueError):
+            logger("DEBUG", "Skipping malformed journal record '%s'"
+                   % line.rstrip("\n"), stdout=False)
+
+    fhandle.close()
+
+    return runs
+
+
+def get_remaining(path):
+    """
+    Return the snapshots the last run in the journal planned but did not
+    destroy.
+
+    Inputs:
+        path (str): Journal file
+    Outputs:
+        snaps (list): Snapshot names and used bytes
+    """
+    runs = read_journal(path)
+    if not runs:
+        logger("ERROR", "There are no runs in the journal to resume")
+        sys.exit(1)
+
+    last = runs[-1]
+    if not last["planned"]:
+        logger("WARN", "The last run was interrupted while listing "
+               "snapshots, any snapshots it didn't list will be destroyed by "
+               "the next full run")
+
+    return [(s, u) for s, u in last["plan"] if s not in last["done"]]
+
+
+def report(path):
+    """
+    Print the throughput of each run in the journal.
+
+    Inputs:
+        path (str): Journal file
+    Outputs:
+        None
+    """
+    fmt = "%-20s %-7s %-11s %8s %8s %10s %9s %10s"
+    print fmt % ("START", "TYPE", "STATUS", "PLANNED", "DONE", "FREED(MB)",
+                 "SNAPS/S", "MB/S")
+
+    for entry in read_journal(path):
+        # Interrupted runs are measured up to their last destroy
+        end = entry["end"] if entry["end"] is not None else entry["last"]
+        elapsed = max(end - entry["start"], 0.001)
+        if entry["end"] is None:
+            status = "interrupted"
+        elif len(entry["done"]) < len(entry["plan"]):
+            status = "incomplete"
+        else:
+            status = "complete"
+        print fmt % (datetime.datetime.fromtimestamp(
+                         int(entry["start"])).strftime("%Y-%m-%d %H:%M:%S"),
+                     entry["type"], status, len(entry["plan"]),
+                     len(entry["done"]),
+                     "%.1f" % (entry["size"] / 1024.0 ** 2),
+                     "%.2f" % (len(entry["done"]) / elapsed),
+                     "%.2f" % (entry["size"] / 1024.0 ** 2 / elapsed))
+
+
+def destroy_batch(dataset, snaps, force=False, pause=0, throttle=None,
+                  journal=None, missing=False):
+    """
+    Destroy a batch of snapshots belonging to the same dataset and report how
+    long the batch took.
+
+    Inputs:
+        dataset       (str): Dataset name
+        snaps        (list): Snapshot names without the dataset component and
+                             used bytes
+        force        (bool): Force destroy
+        pause         (int): Time in seconds to sleep after the batch
+        throttle (Throttle): Adaptive throttle, overrides pause if defined
+        journal   (Journal): Run journal
+        missing      (bool): Treat snapshots that no longer exist as destroyed
+    Outputs:
+        size (int): Used bytes of the snapshots destroyed
+    """
+    for s, _ in snaps:
+        logger("DEBUG", "Batching %s@%s" % (dataset, s))
+
+    logger("INFO", "Destroying %d snapshot(s) of %s" % (len(snaps), dataset))
+    start = time.time()
+    destroy_snaps(dataset, [s for s, _ in snaps], force=force,
+                  missing=missing)
+    latency = time.time() - start
+    if journal is not None:
+        for s, used in snaps:
+            journal.done("%s@%s" % (dataset, s), used)
+    logger("INFO", "Destroyed %d snapshot(s) of %s in %.2f seconds"
+           % (len(snaps), dataset, latency))
+    pace(dataset, latency, pause=pause, throttle=throttle, count=len(snaps))
+
+    return sum(used for _, used in snaps)
+
+
+def destroy_all(snaps, force=False, test=False, pause=0, batch=0,
+                throttle=None, journal=None, missing=False, stop=None):
+    """
+    Destroy snapshots one at a time or, if a batch size is defined, in batches
+    grouped by dataset. In test mode the snapshots are grouped by dataset
+    and the space each dataset would reclaim is estimated for its whole
+    planned set at once, regardless of the batch size. Once stop is set no
+    further destroys are started and queued batches are abandoned.
+
+    Inputs:
+        snaps        (iter): Snapshot names and used bytes
+        force        (bool): Force destroy
+        test         (bool): Test mode
+        pause         (int): Time in seconds to sleep between destroy commands
+        batch         (int): Max snapshots per destroy command, 0 disables
+                             batching
+        throttle (Throttle): Adaptive throttle, overrides pause if defined
+        journal   (Journal): Run journal
+        missing      (bool): Treat snapshots that no longer exist as destroyed
+        stop        (Event): Stop destroying snapshots once set
+    Outputs:
+        count (int): Number of snapshots destroyed
+        size  (int): Used bytes of the snapshots destroyed or, in test mode,
+                     the estimated bytes reclaimed
+    """
+    count = 0
+    size = 0
+
+    # Expired snapshots waiting to be destroyed, keyed by dataset
+    batches = {}
+
+    # Snapshots planned in test mode, keyed by dataset
+    planned = {}
+
+    for snap, used in snaps:
+        if stop is not None and stop.is_set():
+            batches = {}
+            planned = {}
+            break
+
+        count += 1
+
+        if test:
+            logger("INFO", "Destroying %s in test mode" % snap)
+            dataset, name = snap.split("@", 1)
+            planned.setdefault(dataset, []).append(name)
+            continue
+
+        # Queue the snapshot and destroy the batch once it is full
+        if batch:
+            dataset, name = snap.split("@", 1)
+            batches.setdefault(dataset, []).append((name, used))
+            if len(batches[dataset]) >= batch:
+                size += destroy_batch(dataset, batches.pop(dataset),
+                                      force=force, pause=pause,
+                                      throttle=throttle, journal=journal,
+                                      missing=missing)
+            continue
+
+        # Destroy the snapshot
+        logger("INFO", "Destroying %s" % snap)
+        start = time.time()
+        destroy_snap(snap, force=force, missing=missing)
+        size += used
+        if journal is not None:
+            journal.done(snap, used)
+        pace(snap.split("@", 1)[0], time.time() - start, pause=pause,
+             throttle=throttle)
+
+    # Destroy any partially filled batches
+    for dataset in sorted(batches):
+        if stop is not None and stop.is_set():
+            break
+        size += destroy_batch(dataset, batches[dataset], force=force,
+                              pause=pause, throttle=throttle,
+                              journal=journal, missing=missing)
+
+    # Estimate the space reclaimed by each dataset
+    for dataset in sorted(planned):
+        if stop is not None and stop.is_set():
+            break
+        reclaim = estimate_snaps(dataset, planned[dataset])
+        size += reclaim
+        logger("INFO", "Dataset %s would reclaim %.1f MB by destroying %d "
+               "snapshot(s)" % (dataset, reclaim / 1024.0 ** 2,
+                                len(planned[dataset])))
+
+    return count, size
+
+
+def get_partition(snap, top_level=False):
+    """
+    Return the partition a snapshot belongs to. Snapshots in the same
+    partition are destroyed serially by a single worker.
+
+    Inputs:
+        snap       (str): Snapshot name
+        top_level (bool): Partition by top-level dataset instead of by pool
+    Outputs:
+        partition (str): Pool or top-level dataset name
+    """
+    dataset = snap.split("@", 1)[0]
+    if top_level:
+        return "/".join(dataset.split("/")[:2])
+    return dataset.split("/")[0]
+
+
+def destroy_parallel(partitions, jobs, pool_jobs=1, **kwargs):
+    """
+    Destroy snapshots from a pool of worker threads. Each partition is handled
+    by a single worker so logging remains ordered per dataset, and no more
+    than pool_jobs workers operate on the same pool at once. If a worker
+    fails or the run is interrupted the other workers stop after their
+    current destroy, and KeyboardInterrupt is re-raised once they have, so
+    every snapshot destroyed has been journaled.
+
+    Inputs:
+        partitions (dict): Snapshot names and used bytes keyed by partition
+        jobs        (int): Number of worker threads
+        pool_jobs   (int): Max concurrent workers per pool
+        kwargs     (dict): Arguments passed to destroy_all()
+    Outputs:
+        destroyed (dict): Number of snapshots destroyed and their used bytes
+                          keyed by pool
+        failed    (bool): True if any worker failed
+    """
+    work = Queue.Queue()
+    destroyed = {}
+    failed = threading.Event()
+    stop = threading.Event()
+    lock = threading.Lock()
+    limits = {}
+
+    # Interleave partitions from different pools so the workers spread out
+    # across pools rather than queuing behind a single pool's limit
+    by_pool = {}
+    for p in sorted(partitions):
+        pool = p.split("/")[0]
+        by_pool.setdefault(pool, []).append(p)
+        limits[pool] = threading.Semaphore(pool_jobs)
+        destroyed[pool] = [0, 0]
+    while by_pool:
+        for pool in sorted(by_pool):
+            work.put(by_pool[pool].pop(0))
+            if not by_pool[pool]:
+                del by_pool[pool]
+
+    def worker():
+        while not stop.is_set():
+            try:
+                p = work.get_nowait()
+            except Queue.Empty:
+                return
+            pool = p.split("/")[0]
+            with limits[pool]:
+                try:
+                    count, size = destroy_all(partitions[p], stop=stop,
+                                              **kwargs)
+                except SystemExit:
+                    # destroy_snap() has already logged the error
+                    failed.set()
+                    stop.set()
+                    return
+                except Exception, e:
+                    logger("ERROR", "Worker for %s failed: %s" % (p, str(e)))
+                    failed.set()
+                    stop.set()
+                    return
+            with lock:
+                destroyed[pool][0] += count
+                destroyed[pool][1] += size
+
+    threads = []
+    for _ in range(min(jobs, len(partitions))):
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+        threads.append(t)
+
+    # Join with a timeout so the main thread still receives SIGINT
+    try:
+        for t in threads:
+            while t.is_alive():
+                t.join(1)
+    except KeyboardInterrupt:
+        logger("WARN", "Interrupted, waiting for the workers to finish their "
+               "current destroy")
+        stop.set()
+        for t in threads:
+            while t.is_alive():
+                try:
+                    t.join(1)
+                except KeyboardInterrupt:
+                    pass
+        raise
+
+    return destroyed, failed.is_set()
+
+
+def destroy(expired, jobs, pool_jobs=1, top_level=False, test=False,
+            **kwargs):
+    """
+    Destroy the expired snapshots serially or, if jobs is defined, from a pool
+    of worker threads.
+
+    Inputs:
+        expired   (iter): Snapshot names and used bytes
+        jobs       (int): Number of worker threads, 0 destroys serially
+        pool_jobs  (int): Max concurrent workers per pool
+        top_level (bool): Partition work by top-level dataset
+        test      (bool): Test mode
+        kwargs    (dict): Arguments passed to destroy_all()
+    Outputs:
+        count (int): Number of snapshots destroyed
+        size  (int): Used bytes of the snapshots destroyed
+    """
+    if not jobs:
+        return destroy_all(expired, test=test, **kwargs)
+
+    # Partition the expired snapshots and hand them to the workers
+    partitions = {}
+    for snap, used in expired:
+        partitions.setdefault(get_partition(snap, top_level),
+                              []).append((snap, used))
+
+    destroyed, failed = destroy_parallel(partitions, jobs, pool_jobs=pool_jobs,
+                                         test=test, **kwargs)
+
+    # Summarize the run
+    for pool in sorted(destroyed):
+        logger("INFO", "Destroyed %d snapshot(s) in %s%s"
+               % (destroyed[pool][0], pool, " in test mode" if test else ""))
+    if failed:
+        logger("ERROR", "One or more workers failed")
+        sys.exit(1)
+
+    return sum(d[0] for d in destroyed.values()), \
+        sum(d[1] for d in destroyed.values())
+
+
 def main():
     # Initialize arguments
     retention = None
@@ -246,12 +1160,26 @@ def main():
     yes = False
     test = False
     pause = 0
+    adaptive = None
+    batch = 0
+    jobs = 0
+    pool_jobs = 1
+    top_level = False
+    datasets = []
+    resume = False
+    journal_path = journal_file
+    show_report = False
+    policy = None
 
     # Parse command line arguments
     try:
-        opts, args = getopt.getopt(sys.argv[1:], ":hdftyp:r:s:",
-                                   ["help", "retention=", "search=", "force",
-                                    "yes", "test", "pause="])
+        opts, args = getopt.getopt(sys.argv[1:], ":hdftyp:a:r:s:c:b:j:P:TD:R",
+                                   ["help", "retention=", "search=", "config=",
+                                    "force",
+                                    "yes", "test", "pause=", "adaptive=",
+                                    "batch=", "jobs=", "pool-jobs=",
+                                    "top-level", "dataset=", "resume",
+                                    "journal=", "report"])
     except getopt.GetoptError, err:
         print str(err)
         usage()
@@ -272,6 +1200,10 @@ def main():
                 sys.exit(1)
         elif o in ("-s", "--search"):
             search = a
+        elif o in ("-c", "--config"):
+            policy = a
+        elif o in ("-D", "--dataset"):
+            datasets.append(a)
         elif o in ("-f", "--force"):
             force = True
         elif o in ("-p", "--pause"):
@@ -280,10 +1212,54 @@ def main():
             except ValueError:
                 print "The pause duration must be an integer value."
                 sys.exit(1)
+        elif o in ("-a", "--adaptive"):
+            try:
+                adaptive = int(a)
+            except ValueError:
+                print "The target latency must be an integer value."
+                sys.exit(1)
+            if adaptive < 1:
+                print "The target latency must be greater than zero."
+                sys.exit(1)
+        elif o in ("-b", "--batch"):
+            try:
+                batch = int(a)
+            except ValueError:
+                print "The batch size must be an integer value."
+                sys.exit(1)
+            if batch < 1:
+                print "The batch size must be greater than zero."
+                sys.exit(1)
+        elif o in ("-j", "--jobs"):
+            try:
+                jobs = int(a)
+            except ValueError:
+                print "The number of jobs must be an integer value."
+                sys.exit(1)
+            if jobs < 1:
+                print "The number of jobs must be greater than zero."
+                sys.exit(1)
+        elif o in ("-P", "--pool-jobs"):
+            try:
+                pool_jobs = int(a)
+            except ValueError:
+                print "The number of pool jobs must be an integer value."
+                sys.exit(1)
+            if pool_jobs < 1:
+                print "The number of pool jobs must be greater than zero."
+                sys.exit(1)
+        elif o in ("-T", "--top-level"):
+            top_level = True
         elif o in ("-y", "--yes"):
             yes = True
         elif o in ("-t", "--test"):
             test = True
+        elif o in ("-R", "--resume"):
+            resume = True
+        elif o == "--journal":
+            journal_path = a
+        elif o == "--report":
+            show_report = True
         elif o in ("-d"):
             global log_level
             log_level = "DEBUG"
@@ -292,60 +1268,115 @@ def main():
             usage()
             sys.exit(1)
 
+    # The report needs every option parsed, e.g. --journal after --report
+    if show_report:
+        report(journal_path)
+        sys.exit()
+
     # Check required arguments are defined
-    if retention is None:
+    if policy is not None and (retention is not None or search is not None):
+        print "The policy file can't be combined with retention or search."
+        sys.exit(1)
+    if retention is None and not resume and policy is None:
         print "Retention duration required."
         sys.exit(1)
-    if search is None:
+    if search is None and not resume and policy is None:
         print "Search string required."
         sys.exit(1)
+    if pool_jobs > 1 and not top_level:
+        print "Pool jobs require partitioning by top-level dataset."
+        sys.exit(1)
 
     logger("INFO", "STARTING")
 
     # Log arguments
     logger("INFO", "Argument retention=%s" % retention, stdout=False)
     logger("INFO", "Argument search=%s" % search, stdout=False)
+    logger("INFO", "Argument config=%s" % policy, stdout=False)
+    logger("INFO", "Argument datasets=%s" % datasets, stdout=False)
     logger("INFO", "Argument force=%s" % force, stdout=False)
     logger("INFO", "Argument pause=%s" % pause, stdout=False)
+    logger("INFO", "Argument adaptive=%s" % adaptive, stdout=False)
+    logger("INFO", "Argument batch=%s" % batch, stdout=False)
+    logger("INFO", "Argument jobs=%s" % jobs, stdout=False)
+    logger("INFO", "Argument pool_jobs=%s" % pool_jobs, stdout=False)
+    logger("INFO", "Argument top_level=%s" % top_level, stdout=False)
     logger("INFO", "Argument yes=%s" % yes, stdout=False)
     logger("INFO", "Argument test=%s" % test, stdout=False)
-
-    # Cutoff date
-    cutoff = datetime.datetime.now() - datetime.timedelta(days=retention)
+    logger("INFO", "Argument resume=%s" % resume, stdout=False)
+    logger("INFO", "Argument journal=%s" % journal_path, stdout=False)
 
     # Prompt user before continuing due to destructive nature of this script
-    logger("INFO", "Snapshots created before %s and matching \"%s\" will be "
-           "destroyed" % (cutoff, search))
+    if resume:
+        remaining = get_remaining(journal_path)
+        logger("INFO", "%d snapshot(s) remaining from the last run will be "
+               "destroyed" % len(remaining))
+    elif policy is not None:
+        rules = read_policy(policy)
+        cutoff = datetime.datetime.now() - \
+            datetime.timedelta(days=min_retention)
+        for r in rules:
+            logger("INFO", "Rule %s" % r)
+        logger("INFO", "Snapshots created before %s and not retained by a "
+               "rule will be destroyed" % cutoff)
+    else:
+        cutoff = datetime.datetime.now() - datetime.timedelta(days=retention)
+        logger("INFO", "Snapshots created before %s and matching \"%s\" will "
+               "be destroyed" % (cutoff, search))
     if not test and not yes:
         if not prompt_yn("Are you sure you want to continue?"):
             sys.exit(1)
 
-    for snap, creation in get_snaps():
-        # Skip syspool snapshots
-        if snap.startswith("syspool"):
-            logger("DEBUG", "Skipping syspool snapshot %s" % snap)
-            continue
+    # Adaptive throttle
+    throttle = None
+    if adaptive is not None:
+        throttle = Throttle(adaptive / 1000.0, pause=pause)
 
-        # Skip snapshots that don't containt the search string
-        if search is not None and search not in snap:
-            logger("DEBUG", "Skipping %s, does not contain search string"
-                   % snap)
-            continue
+    start = time.time()
+    if resume:
+        expired = remaining
+    elif policy is not None:
+        roots = get_roots(datasets, [r.dataset for r in rules])
+        logger("INFO", "Listing snapshots of %s" % ", ".join(roots))
+        expired = get_policy_expired(get_snaps(roots), rules, cutoff)
+    else:
+        roots = get_roots(datasets)
+        logger("INFO", "Listing snapshots of %s" % ", ".join(roots))
+        expired = get_expired(get_snaps(roots, cutoff), search, cutoff)
 
-        # Skip snapshots that don't meet the retention policy
-        if datetime.datetime.fromtimestamp(int(creation)) > cutoff:
-            logger("DEBUG", "Skipping %s, does not meet retention policy"
-                   % snap)
-            continue
+    # Test mode runs are not journaled so they can't be resumed
+    journal = None
+    if not test:
+        try:
+            journal = Journal(journal_path)
+        except IOError, e:
+            logger("ERROR", "Unable to open journal: %s" % str(e))
+            sys.exit(1)
+        journal.start(resume)
+        expired = journal.plan(expired)
 
-        # Destroy the snapshot
-        if test:
-            logger("INFO", "Destroying %s in test mode" % snap)
-        else:
-            logger("INFO", "Destroying %s" % snap)
-            destroy_snap(snap, force=force)
-            logger("INFO", "Sleeping for %s" % pause)
-            time.sleep(pause)
+    # An interrupted or failed run is journaled without an END record
+    completed = False
+    try:
+        count, size = destroy(expired, jobs, pool_jobs=pool_jobs,
+                              top_level=top_level, force=force, test=test,
+                              pause=pause, batch=batch, throttle=throttle,
+                              journal=journal, missing=resume)
+        completed = True
+    finally:
+        if journal is not None:
+            journal.close(completed)
+
+    elapsed = max(time.time() - start, 0.001)
+    if test:
+        logger("INFO", "Destroying %d snapshot(s) in test mode would reclaim "
+               "%.1f MB, estimated in %.2f seconds"
+               % (count, size / 1024.0 ** 2, elapsed))
+    else:
+        logger("INFO", "Destroyed %d snapshot(s) totalling %.1f MB in %.2f "
+               "seconds" % (count, size / 1024.0 ** 2, elapsed))
+        logger("INFO", "Throughput %.2f snapshots/sec, %.2f MB/sec"
+               % (count / elapsed, size / 1024.0 ** 2 / elapsed))
 
     logger("INFO", "FINISHED")
 
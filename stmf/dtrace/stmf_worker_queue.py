@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+
+"""
+stmf_worker_queue.py
+
+Sample the stmf queue depth and the number of allocated worker threads and
+print the min/avg/max of each per window.
+
+A single DTrace consumer reads both kernel variables in the same probe
+firing, so each sample is consistent and nothing is forked per sample.
+Samples are kept in a bounded ring buffer which can be saved on exit.
+
+William Kettler <william.kettler@nexenta.com>
+Copyright 2014, Nexenta Systems, Inc.
+"""
+
+import os
+import sys
+import time
+import getopt
+import signal
+import collections
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", ".."))
+from command import Command
+
+DTRACE = "/usr/sbin/dtrace"
+
+# Output line format
+fmt = "%-20s" + "%10s" * 7
+
+# The tunables are printed once, then a sample is printed every tick
+script = """
+BEGIN
+{
+    printf("T %%d %%d\\n", `stmf_min_nworkers, `stmf_max_nworkers);
+}
+
+profile:::tick-%dms
+{
+    printf("S %%d %%d %%d\\n", walltimestamp, `stmf_cur_ntasks,
+        `stmf_nworkers_cur);
+}
+"""
+
+
+def usage():
+    """
+    Print usage.
+
+    Inputs:
+        None
+    Outputs:
+        None
+    """
+    cmd = sys.argv[0]
+
+    print "%s [-h] [-i MS] [-w SECONDS] [-b SAMPLES] [-s FILE]" % cmd
+    print ""
+    print "Sample the stmf queue depth and worker threads and print the " \
+          "min/avg/max"
+    print "per window."
+    print ""
+    print "Arguments:"
+    print ""
+    print "    -h, --help           print usage"
+    print "    -i, --interval MS    sample interval in milliseconds, " \
+          "defaults to 100"
+    print "    -w, --window SECONDS window length in seconds, defaults to 5"
+    print "    -b, --buffer SAMPLES ring buffer size in samples, defaults " \
+          "to 6000"
+    print "    -s, --save FILE      save the ring buffer to FILE on exit"
+
+
+class Window(object):
+    """
+    Min/avg/max of the samples in one window.
+    """
+    def __init__(self, start):
+        self.start = start
+        self.count = 0
+        self.ntasks = [None, 0, None]
+        self.nworkers = [None, 0, None]
+
+    def add(self, ntasks, nworkers):
+        self.count += 1
+        for stat, value in ((self.ntasks, ntasks),
+                            (self.nworkers, nworkers)):
+            if stat[0] is None or value < stat[0]:
+                stat[0] = value
+            if stat[2] is None or value > stat[2]:
+                stat[2] = value
+            stat[1] += value
+
+    def __str__(self):
+        date = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.start))
+        fields = [date]
+        for stat in (self.ntasks, self.nworkers):
+            fields.extend([str(stat[0]), "%.1f" % (float(stat[1]) /
+                                                   self.count), str(stat[2])])
+        fields.append(str(self.count))
+        return fmt % tuple(fields)
+
+
+def save(samples, path):
+    """
+    Save the ring buffer as one tab separated sample per line.
+
+    Inputs:
+        samples (deque): (time, ntasks, nworkers) samples
+        path      (str): Output file
+    Outputs:
+        None
+    """
+    try:
+        with open(path, "w") as f:
+            for s in samples:
+                f.write("%.3f\t%d\t%d\n" % s)
+    except IOError, e:
+        sys.stderr.write("[ERROR] saving samples to %s: %s\n" % (path, e))
+
+
+def sample(interval, window, samples):
+    """
+    Start the DTrace consumer and print a line per window until it exits.
+
+    Inputs:
+        interval  (int): Sample interval in milliseconds
+        window    (int): Window length in seconds
+        samples (deque): Ring buffer of (time, ntasks, nworkers) samples
+    Outputs:
+        retcode (int): DTrace exit status
+    """
+    cmd = [DTRACE, "-q", "-x", "switchrate=%dhz" % max(1, 1000 / interval),
+           "-n", script % interval]
+    command = Command(cmd)
+    lines = iter(command)
+
+    current = None
+    try:
+        for line in lines:
+            fields = line.split()
+            if not fields:
+                continue
+            elif fields[0] == "T":
+                print "stmf_min_nworkers: %s" % fields[1]
+                print "stmf_max_nworkers: %s" % fields[2]
+                print ""
+                print fmt % ("DATE", "MIN_TASKS", "AVG_TASKS", "MAX_TASKS",
+                             "MIN_WRK", "AVG_WRK", "MAX_WRK", "SAMPLES")
+                sys.stdout.flush()
+                continue
+            elif fields[0] != "S":
+                continue
+
+            now = int(fields[1]) / 1e9
+            ntasks, nworkers = int(fields[2]), int(fields[3])
+            samples.append((now, ntasks, nworkers))
+
+            # Windows are aligned to multiples of the window length
+            start = now - now % window
+            if current is not None and start != current.start:
+                print current
+                sys.stdout.flush()
+                current = None
+            if current is None:
+                current = Window(start)
+            current.add(ntasks, nworkers)
+    finally:
+        # Kills DTrace if sampling was interrupted
+        lines.close()
+        if command.errors:
+            sys.stderr.write(command.errors)
+
+    return command.retcode
+
+
+def terminate(signum, frame):
+    sys.exit(0)
+
+
+def main():
+    # Define command line options
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], ":hi:w:b:s:",
+                                   ["help", "interval=", "window=",
+                                    "buffer=", "save="])
+    except getopt.GetoptError, err:
+        sys.stderr.write(str(err))
+        usage()
+        sys.exit(2)
+
+    # Initialize arguments
+    interval = 100
+    window = 5
+    size = 6000
+    path = None
+
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif o in ("-s", "--save"):
+            path = a
+        elif o in ("-i", "--interval", "-w", "--window", "-b", "--buffer"):
+            try:
+                value = int(a)
+            except ValueError:
+                value = 0
+            if value < 1:
+                sys.stderr.write("%s must be an integer greater than zero.\n"
+                                 % o)
+                sys.exit(1)
+            if o in ("-i", "--interval"):
+                interval = value
+            elif o in ("-w", "--window"):
+                window = value
+            else:
+                size = value
+
+    # Make sure only root can run script
+    if os.geteuid() != 0:
+        sys.stderr.write("This script must be run as root\n")
+        sys.exit(1)
+
+    # Exit cleanly when stopped by stmf-debug so the samples can be saved
+    signal.signal(signal.SIGTERM, terminate)
+
+    samples = collections.deque(maxlen=size)
+    retcode = 0
+    try:
+        retcode = sample(interval, window, samples)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if path is not None:
+            save(samples, path)
+
+    sys.exit(retcode)
+
+
+if __name__ == "__main__":
+    main()
@@ -11,12 +11,17 @@
 DATE=$(date +%Y-%m-%d:%H:%M:%S)
 LOG="stmf-debug.log"
 PERF_DIR="perflogs/${DATE}"
-PID_LOG="/var/tmp/stmf-debug.pid"
+STATE="/var/tmp/stmf-debug.json"
+AGG_INTERVAL=60
+
+# Collector output is rotated into SEGMENT_MB or SEGMENT_SECS segments which
+# are compressed, the oldest are removed to keep the capture under BUDGET_MB
+CAPTURE="$(dirname $0)/../capture.py"
+SEGMENT_MB=100
+SEGMENT_SECS=3600
+BUDGET_MB=2048
 
 ECHO="/usr/gnu/bin/echo -ne"
-KILL="/usr/bin/kill"
-RM="/usr/bin/rm"
-NOHUP="/usr/bin/nohup"
 MKDIR="/usr/bin/mkdir -p"
 
 usage() {
@@ -24,13 +29,18 @@ usage() {
     ${ECHO} "NexentaStor.\n"
     ${ECHO} "\n"
     ${ECHO} "USAGE\n"
-    ${ECHO} "    $0 <command>\n"
+    ${ECHO} "    $0 <command> [agg]\n"
     ${ECHO} "\n"
     ${ECHO} "COMMAND\n"
     ${ECHO} "    start  : start collecting performance data.\n"
     ${ECHO} "    status : displays any running dtrace scripts it has invoked.\n"
     ${ECHO} "    stop   : attempt to stop the dtrace scripts it started.\n"
     ${ECHO} "\n"
+    ${ECHO} "OPTIONS\n"
+    ${ECHO} "    agg    : start stmf_task_time_th.d in aggregate-only mode,\n"
+    ${ECHO} "             printing per LU histograms every ${AGG_INTERVAL}\n"
+    ${ECHO} "             seconds rather than a line per slow task.\n"
+    ${ECHO} "\n"
 }
 
 write_log() {
@@ -39,75 +49,44 @@ write_log() {
     ${ECHO} ${msg} >> ${LOG}
 }
 
-background() {
-    write_log "INFO" "Running $1"
-    ${NOHUP} $1 2>&1 &
-    ${ECHO} "$!\n" >> ${PID_LOG}
-}
-
-background_log() {
-    write_log "INFO" "Running $1"
-    ${NOHUP} $1 > "${PERF_DIR}/$2" 2>&1 &
-    ${ECHO} "$!\n" >> ${PID_LOG}
-}
-
 stop() {
-    # Make sure the PID file exists o/w there isn't an active session
-    if [ -f ${PID_LOG} ]; then
-        write_log "INFO" "Stopping stmf-debug"
-        # Make sure each pid is alive
-        while read p; do
-            write_log "INFO" "Killing process ID ${p}"
-            ${KILL} "${p}"
-        done < ${PID_LOG}
-
-        ${RM} ${PID_LOG}
-    else
-        write_log "ERROR" "stmf-debug is not running"
-    fi
+    write_log "INFO" "Stopping stmf-debug"
+    ${CAPTURE} stop -S ${STATE} | tee -a ${LOG}
 }
 
 start() {
     # Make performance log directory
     ${MKDIR} -p ${PERF_DIR}
 
-    if [ -f ${PID_LOG} ]; then
-        write_log "ERROR" "stmf-debug is already running"
-        return
-    fi
-
     write_log "INFO" "Starting monitoring scripts"
 
     # Define all collection scripts here
-    background_log "dtrace/stmf_task_time_th.d 1000" "stmf_task_time_th.out"
-    background_log "dtrace/stmf_worker_queue.sh 5" "stmf_worker_queue.out"
-    background_log "dtrace/iscsit_sessions.d" "iscsit_sessions.out"
+    if [ "$1" == "agg" ]; then
+        task_time="dtrace/stmf_task_time_th.d 1000 agg ${AGG_INTERVAL}"
+    else
+        task_time="dtrace/stmf_task_time_th.d 1000"
+    fi
+    ${CAPTURE} start -S ${STATE} -d ${PERF_DIR} -s ${SEGMENT_MB} \
+        -t ${SEGMENT_SECS} -b ${BUDGET_MB} \
+        "stmf_task_time_th.out=${task_time}" \
+        "stmf_worker_queue.out=dtrace/stmf_worker_queue.py -i 100 -w 5 -s ${PERF_DIR}/stmf_worker_queue.samples" \
+        "iscsit_sessions.out=dtrace/iscsit_sessions.d" | tee -a ${LOG}
+    if [ ${PIPESTATUS[0]} -ne 0 ]; then
+        write_log "ERROR" "Monitoring scripts failed to start"
+        return
+    fi
 
     write_log "INFO" "Monitoring scripts started"
 }
 
 status() {
-    # Make sure the PID file exists o/w there isn't an active session
-    if [ -f ${PID_LOG} ]; then
-        write_log "INFO" "stmf-debug is running"
-        # Make sure each pid is alive
-        while read p; do
-            ${KILL} -0 "${p}" 2> /dev/null
-            if [ $? -eq 0 ]; then
-                write_log "INFO" "Process ID ${p} is running"
-            else
-                write_log "ERROR" "Process ID ${p} has died"
-            fi
-        done < ${PID_LOG}
-    else
-        write_log "INFO" "stmf-debug is not running"
-    fi
+    ${CAPTURE} status -S ${STATE} | tee -a ${LOG}
 }
 
 subcommand="$1"
 case "${subcommand}" in
     start )
-        start
+        start "$2"
         exit 0
         ;;
     stop )
@@ -0,0 +1,452 @@
+#!/usr/bin/env python
+
+"""
+stmf-task-time.py
+
+Summarise the output of dtrace/stmf_task_time_th.d. The capture is read
+through a memory map, or decompressed, one line at a time and every time
+component is counted into a histogram per LU and per opcode, so memory use
+doesn't depend on the size of the capture. Values are bucketed by their number
+of digits and two leading digits straight from the text, so no value is
+converted to an integer, into 20 buckets per power of ten.
+
+For each interval the p50/p99/p999 of each component is printed along with
+the share of the task time spent in the wait queue (qtime), the LU (lu) and
+on the wire (lport). Shares are estimated from the bucket midpoints and the
+largest share is marked with a '*'.
+
+William Kettler <william.kettler@nexenta.com>
+Copyright 2016, Nexenta Systems, Inc.
+"""
+
+import os
+import sys
+import time
+import math
+import mmap
+import gzip
+import getopt
+import itertools
+
+# Time components in the order they are reported by stmf_task_time_th.d
+components = ["lu", "lport", "qtime", "task"]
+
+# Components the task time is made up of
+parts = ["lu", "lport", "qtime"]
+
+# Max digits of a value, enough for any 64-bit value
+ndigits = 20
+
+# Buckets per power of ten for values of two or more digits
+steps = 20
+
+# Single digit values have a bucket each, longer values steps buckets for
+# each number of digits
+nbuckets = 10 + steps * (ndigits - 1)
+
+# Output line format
+fmt = "%-20s %-6s %-40s %-6s %9s %10s %10s %10s %7s"
+
+
+def usage():
+    """
+    Print usage.
+
+    Inputs:
+        None
+    Outputs:
+        None
+    """
+    cmd = sys.argv[0]
+
+    print "%s [-h] [-i SECONDS] [-t] FILE..." % cmd
+    print ""
+    print "Summarise stmf_task_time_th.d output per interval. The files, " \
+          "e.g. the"
+    print "segments of a capture, are read in order and may be gzipped."
+    print ""
+    print "Arguments:"
+    print ""
+    print "    -h, --help           print usage"
+    print "    -i, --interval SECONDS"
+    print "                         interval length in seconds, defaults " \
+          "to 60"
+    print "    -t, --total          only print the summary of the whole " \
+          "capture"
+
+
+def bucket(n, v):
+    """
+    Return the bucket of a value. Buckets 0-9 count the single digit values,
+    bucket 10 + steps * (n - 2) + k counts the n digit values whose leading
+    digits fall in the kth of steps equal logarithmic steps of a power of
+    ten, so no bucket is wider than a fifth of its lowest value.
+
+    Inputs:
+        n (int): Number of digits
+        v (int): Value if n is 1, otherwise its two leading digits
+    Outputs:
+        bucket (int): Bucket index
+    """
+    if n == 1:
+        return v
+    return 10 + steps * (n - 2) + int(steps * math.log10(v / 10.0))
+
+
+def bucket_ranges():
+    """
+    Return the range of values counted by each bucket.
+
+    Inputs:
+        None
+    Outputs:
+        ranges (list): Lowest value and number of values of each bucket
+    """
+    ranges = [(v, 1) for v in range(10)]
+    for n in range(2, ndigits + 1):
+        scale = 10 ** (n - 2)
+        for v in range(10, 100):
+            i = bucket(n, v)
+            if i == len(ranges):
+                ranges.append((v * scale, scale))
+            else:
+                low, width = ranges[i]
+                ranges[i] = (low, width + scale)
+    return ranges
+
+
+# Range of values each bucket counts and their mean, used to estimate totals
+ranges = bucket_ranges()
+midpoints = [low + (width - 1) / 2.0 for low, width in ranges]
+
+
+def bucket_tables(offset):
+    """
+    Return the bucket of a value string, indexed by its length and then its
+    two leading digits, plus an offset.
+
+    Inputs:
+        offset (int): Offset added to each bucket
+    Outputs:
+        tables (list): A dict of leading digits to bucket for each length
+    """
+    tables = [{}, dict((str(v), offset + v) for v in range(10))]
+    for n in range(2, ndigits + 1):
+        tables.append(dict((str(v), offset + bucket(n, v))
+                           for v in range(10, 100)))
+    return tables
+
+
+class Histogram(object):
+    """
+    A histogram of a time component in usecs, see bucket().
+    """
+    def __init__(self, buckets):
+        """
+        Inputs:
+            buckets (list): Counts of each bucket
+        """
+        self.nonzero = zip(used(buckets), itertools.compress(buckets,
+                                                             buckets))
+        self.count = sum(buckets)
+
+    @property
+    def total(self):
+        """
+        The sum of the values, estimated from the bucket midpoints.
+        """
+        return sum(c * midpoints[i] for i, c in self.nonzero)
+
+    def percentile(self, p):
+        """
+        Return a percentile, interpolated linearly within its bucket.
+
+        Inputs:
+            p (float): Percentile, e.g. 99.9
+        Outputs:
+            value (int): Percentile in usecs
+        """
+        if not self.count:
+            return 0
+
+        rank = self.count * p / 100.0
+        seen = 0
+        for i, c in self.nonzero:
+            if seen + c >= rank:
+                break
+            seen += c
+
+        low, width = ranges[i]
+        return int(low + (width - 1) * min(rank - seen, c) / c)
+
+
+class Summary(object):
+    """
+    Histograms of every component for each task line prefix, i.e. opcode
+    and LU. Each prefix has a flat list of nbuckets counters per component
+    so a task is counted with a single lookup. Few of the counters are used,
+    so only the non-zero counters are visited when merging and when the
+    per-LU and per-opcode histograms are built for reporting.
+    """
+    def __init__(self):
+        self.counters = {}
+
+    def merge(self, other):
+        for prefix, counters in other.counters.iteritems():
+            mine = self.counters.get(prefix)
+            if mine is None:
+                mine = self.counters[prefix] = [0] * len(counters)
+            for i in used(counters):
+                mine[i] += counters[i]
+
+    def __len__(self):
+        return len(self.counters)
+
+    def groups(self):
+        """
+        Return the histograms of every component for each LU and opcode.
+
+        Inputs:
+            None
+        Outputs:
+            groups (dict): Histograms keyed by (group, key), where the group
+                           is either "lu" or "op"
+        """
+        sums = {}
+        for prefix, counters in self.counters.iteritems():
+            op, lu = parse_prefix(prefix)
+            size = len(counters)
+            lu_sums = sums.setdefault(("lu", lu), [0] * size)
+            op_sums = sums.setdefault(("op", op), [0] * size)
+            for i in used(counters):
+                c = counters[i]
+                lu_sums[i] += c
+                op_sums[i] += c
+
+        groups = {}
+        for k, counters in sums.iteritems():
+            groups[k] = [Histogram(counters[i * nbuckets:(i + 1) * nbuckets])
+                         for i in range(len(components))]
+
+        return groups
+
+    def report(self, label):
+        """
+        Print a line per component for every LU and opcode.
+
+        Inputs:
+            label (str): Interval label
+        Outputs:
+            None
+        """
+        groups = self.groups()
+        for group, key in sorted(groups):
+            hists = groups[(group, key)]
+            totals = dict((c, h.total) for c, h in zip(components, hists))
+            whole = sum(totals[c] for c in parts)
+            dominant = max(parts, key=lambda c: totals[c])
+            for c, h in zip(components, hists):
+                if c in parts and whole:
+                    share = "%.0f%%" % (100.0 * totals[c] / whole)
+                    if c == dominant:
+                        share += "*"
+                else:
+                    share = "-"
+                print fmt % (label, group, key, c, h.count,
+                             h.percentile(50), h.percentile(99),
+                             h.percentile(99.9), share)
+
+
+def used(counters):
+    """
+    Return the indices of the non-zero counters.
+
+    Inputs:
+        counters (list): Counters
+    Outputs:
+        indices (iter): Indices of the non-zero counters
+    """
+    return itertools.compress(xrange(len(counters)), counters)
+
+
+def parse_prefix(prefix):
+    """
+    Split a task line prefix, e.g. "read (0x28) /dev/zvol/rdsk/tank/lu0",
+    into the opcode and LU.
+
+    Inputs:
+        prefix (str): Task line prefix
+    Outputs:
+        op (str): Opcode, e.g. "read (0x28)"
+        lu (str): LU name
+    """
+    fields = prefix.split(" ", 2)
+    if len(fields) != 3:
+        return prefix, ""
+    return "%s %s" % (fields[0], fields[1]), fields[2]
+
+
+def parse_marker(line):
+    """
+    Return the time of an interval marker, e.g. "-- 2016 Jan  5 10:00:00".
+
+    Inputs:
+        line (str): Marker line
+    Outputs:
+        marker (float): Seconds since the epoch, None if invalid
+    """
+    try:
+        return time.mktime(time.strptime(" ".join(line[3:].split()),
+                                         "%Y %b %d %H:%M:%S"))
+    except ValueError:
+        return None
+
+
+def read_files(paths):
+    """
+    Generate an iterator over the lines of each file in turn, so lines are
+    read without passing through another generator. Plain files are read
+    through a memory map, segments compressed by capture.py are decompressed
+    as they are read. Each file is closed once its lines have been consumed.
+
+    Inputs:
+        paths (list): Files
+    Outputs:
+        lines (iter): Lines of the file, generated for each file
+    """
+    for path in paths:
+        if path.endswith(".gz"):
+            f = gzip.open(path, "rb")
+            try:
+                yield f
+            finally:
+                f.close()
+            continue
+
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                continue
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                yield iter(m.readline, "")
+            finally:
+                m.close()
+
+
+def analyze(paths, interval, total_only):
+    """
+    Stream the capture and print a summary per interval followed by a
+    summary of the whole capture.
+
+    Inputs:
+        paths      (list): stmf_task_time_th.d output, in capture order
+        interval    (int): Interval length in seconds
+        total_only (bool): Only print the whole capture summary
+    Outputs:
+        None
+    """
+    total = Summary()
+    current = Summary()
+    label = "start"
+    start = None
+
+    print fmt % ("INTERVAL", "GROUP", "KEY", "TIME", "COUNT", "P50(us)",
+                 "P99(us)", "P999(us)", "SHARE")
+
+    def flush():
+        if len(current):
+            if not total_only:
+                current.report(label)
+            total.merge(current)
+
+    # Buckets of each component, offset within a prefix's list
+    lu, lport, qtime, task = [bucket_tables(i * nbuckets)
+                              for i in range(len(components))]
+    size = len(components) * nbuckets
+
+    counters = current.counters
+    for lines in read_files(paths):
+        for line in lines:
+            c = line[0]
+            if c == "r" or c == "w":
+                # e.g. "read (0x28) <lu>: lu/lport/qtime/task (usecs)", a line
+                # torn within the values has no unit and is skipped
+                prefix, sep, values = line.rpartition(": ")
+                values, sep, unit = values.partition(" ")
+                if not sep:
+                    continue
+                try:
+                    a, b, q, t = values.split("/")
+                    a = lu[len(a)][a[:2]]
+                    b = lport[len(b)][b[:2]]
+                    q = qtime[len(q)][q[:2]]
+                    t = task[len(t)][t[:2]]
+                except (ValueError, IndexError, KeyError):
+                    continue
+                h = counters.get(prefix)
+                if h is None:
+                    h = counters[prefix] = [0] * size
+                h[a] += 1
+                h[b] += 1
+                h[q] += 1
+                h[t] += 1
+            elif c == "-" and line.startswith("-- "):
+                marker = parse_marker(line)
+                if marker is None:
+                    continue
+                aligned = marker - marker % interval
+                if start is None or aligned != start:
+                    flush()
+                    current = Summary()
+                    counters = current.counters
+                    start = aligned
+                    label = time.strftime("%Y-%m-%d %H:%M:%S",
+                                          time.localtime(aligned))
+
+    flush()
+    total.report("total")
+
+
+def main():
+    # Define command line options
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], ":hi:t",
+                                   ["help", "interval=", "total"])
+    except getopt.GetoptError, err:
+        sys.stderr.write(str(err))
+        usage()
+        sys.exit(2)
+
+    # Initialize arguments
+    interval = 60
+    total_only = False
+
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif o in ("-t", "--total"):
+            total_only = True
+        elif o in ("-i", "--interval"):
+            try:
+                interval = int(a)
+            except ValueError:
+                interval = 0
+            if interval < 1:
+                sys.stderr.write("The interval must be an integer greater "
+                                 "than zero.\n")
+                sys.exit(1)
+
+    if not args:
+        usage()
+        sys.exit(2)
+
+    try:
+        analyze(args, interval, total_only)
+    except (IOError, OSError), e:
+        sys.stderr.write("[ERROR] %s\n" % e)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
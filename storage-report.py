@@ -11,49 +11,121 @@ Copyright (c) 2016  Nexenta Systems
 William Kettler <william.kettler@nexenta.com>
 """
 
+import getopt
+import itertools
 import sys
 import time
-import commands
 import socket
+import threading
+import Queue
+from command import Command, stream, Retcode
+from writers import formats, get_writer
 
+# Size units
+units = {
+    "B": 1,
+    "K": 1024,
+    "M": 1024 ** 2,
+    "G": 1024 ** 3,
+    "T": 1024 ** 4
+}
 
-def pprint_table(table):
+
+def usage():
     """
-    Pretty print table.
+    Print usage.
 
     Inputs:
-        table (list): table
+        None
     Outputs:
         None
     """
-    padding = []
-
-    # Get the max width of each column
-    for i in range(len(table[0])):
-        padding.append(max([len(row[i]) for row in table]))
+    cmd = sys.argv[0]
 
-    # Print header
-    header = table.pop(0)
-    width = []
-    for index, item in enumerate(header):
-        width.append(len(item))
-        col = item.rjust(padding[index] + 2)
-        print col,
+    print "%s [-h] [-o FORMAT] [-p POOL]... [-D DATASET]... [-d DEPTH] " \
+          "[-j JOBS]" % cmd
     print ""
-
-    # Print header delimiter
-    for index, item in enumerate(width):
-        under = "-" * item
-        col = under.rjust(padding[index] + 2)
-        print col,
+    print "Report storage utilization. The report is printed and saved to " \
+          "a file."
+    print ""
+    print "Arguments:"
     print ""
+    print "    -h, --help           print usage"
+    print "    -o, --format FORMAT  saved report format, one of %s, " \
+          "defaults" % ", ".join(formats)
+    print "                         to csv, json and ndjson sizes are in " \
+          "bytes"
+    print "    -p, --pool POOL      report POOL, may be repeated"
+    print "    -D, --dataset DATASET"
+    print "                         report DATASET and its descendants, may " \
+          "be"
+    print "                         repeated"
+    print "    -d, --depth DEPTH    report at most DEPTH levels below each " \
+          "pool or"
+    print "                         dataset"
+    print "    -j, --jobs JOBS      run one zfs list per pool or dataset, " \
+          "JOBS at a"
+    print "                         time"
+
+
+class Table(object):
+    """
+    A table stored by column. Column widths are maintained as rows are
+    appended so the table can be rendered in a single pass.
+    """
+    def __init__(self, header):
+        """
+        Inputs:
+            header (list): Column headers
+        """
+        self.header = list(header)
+        self.columns = [[] for h in self.header]
+        self.widths = [len(h) for h in self.header]
 
-    # Print table contents
-    for row in table:
-        for index, item in enumerate(row):
-            col = item.rjust(padding[index] + 2)
-            print col,
-        print ""
+    def append(self, row):
+        """
+        Append a row.
+
+        Inputs:
+            row (list): Row, one string per column
+        Outputs:
+            None
+        """
+        for i, item in enumerate(row):
+            self.columns[i].append(item)
+            if len(item) > self.widths[i]:
+                self.widths[i] = len(item)
+
+    def __len__(self):
+        return len(self.columns[0]) if self.columns else 0
+
+    def render(self, fhandle=None, lines=1000):
+        """
+        Pretty print the table. Each column is right justified to its widest
+        item plus two spaces and whole lines are written in batches.
+
+        Inputs:
+            fhandle (file): Output file, defaults to STDOUT
+            lines    (int): Lines per write
+        Outputs:
+            None
+        """
+        fhandle = fhandle or sys.stdout
+        fmt = " ".join("%%%ds" % (w + 2) for w in self.widths) + "\n"
+
+        # Print header and header delimiter
+        fhandle.write(fmt % tuple(self.header))
+        fhandle.write(fmt % tuple("-" * len(h) for h in self.header))
+
+        # Print table contents
+        batch = []
+        for row in itertools.izip(*self.columns):
+            batch.append(fmt % row)
+            if len(batch) == lines:
+                fhandle.write("".join(batch))
+                batch = []
+        fhandle.write("".join(batch))
+        fhandle.flush()
 
 
 def get_hostname():
@@ -70,52 +142,234 @@ def get_hostname():
     return hostname
 
 
-def get_zfs_space(unit):
+def get_pools():
     """
-    Parse the output of `zfs list -o space` and convert to the defined unit.
+    Return all imported pools.
 
     Inputs:
-        unit (str): Unit, e.g. B,K,M,G,T
+        None
     Outputs:
-        table (list): Pased output of `zfs list -o space`
-    """
-    units = {
-        "B": 1,
-        "K": 1024,
-        "M": 1024 ** 2,
-        "G": 1024 ** 3,
-        "T": 1024 ** 4
-    }
-    table = []
-
-    retcode, output = commands.getstatusoutput("zfs list -p -o space")
-    if retcode:
+        pools (list): Pool names
+    """
+    try:
+        return [l.strip() for l in stream(["zpool", "list", "-H", "-o",
+                                           "name"])]
+    except Retcode, r:
         print "[ERROR] Command execution failed"
-        print output
+        print r.output.strip()
         sys.exit(1)
 
-    # Iterate over the command output
-    header = True
-    for line in output.splitlines():
-        row = line.split()
-        if header:
-            header = False
-        else:
-            for i in range(1, len(row)):
-                row[i] = "%.1f%s" % (float(int(row[i]) / units[unit]), unit)
-        table.append(row)
 
-    return table
+def zfs_list_cmd(targets=None, depth=None):
+    """
+    Return the `zfs list -o space` command for the given scope.
+
+    Inputs:
+        targets (list): Pools or dataset roots, all datasets if None
+        depth    (int): Maximum depth below each root, unlimited if None
+    Outputs:
+        cmd (list): Command and arguments
+    """
+    cmd = ["zfs", "list", "-p", "-o", "space"]
+    if depth is not None:
+        cmd.extend(["-d", str(depth)])
+    elif targets:
+        cmd.append("-r")
+
+    return cmd + list(targets or [])
+
+
+def collect_serial(targets, depth):
+    """
+    Execute one `zfs list` per target in turn, generating its output as it
+    is read. The collection time of each target is printed to STDERR.
+
+    Inputs:
+        targets (list): Pools or dataset roots
+        depth    (int): Maximum depth below each root, unlimited if None
+    Outputs:
+        line (str): STDOUT line, generated for each line of output
+    """
+    for i, target in enumerate(targets):
+        command = Command(zfs_list_cmd([target], depth))
+        # Only the first target's header is kept
+        for line in itertools.islice(command, 1 if i else 0, None):
+            yield line
+        if command.retcode:
+            raise Retcode(command.cmd, command.retcode,
+                          output=command.errors, elapsed=command.elapsed)
+        sys.stderr.write("[INFO] %s took %.1f second(s)\n"
+                         % (target, command.elapsed))
+
+
+def collect(targets, depth, jobs):
+    """
+    Execute one `zfs list` per target using a pool of threads. The output of
+    each target is generated in target order as soon as it and every
+    preceding target complete. The collection time of each target is
+    printed to STDERR.
+
+    Inputs:
+        targets (list): Pools or dataset roots
+        depth    (int): Maximum depth below each root, unlimited if None
+        jobs     (int): Number of concurrent commands
+    Outputs:
+        line (str): STDOUT line, generated for each line of output
+    """
+    commands = [Command(zfs_list_cmd([t], depth)) for t in targets]
+    outputs = [None] * len(targets)
+    done = [threading.Event() for t in targets]
+    queue = Queue.Queue()
+    for i in range(len(targets)):
+        queue.put(i)
+
+    def worker():
+        while True:
+            try:
+                i = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                outputs[i] = list(commands[i])
+            except Exception, e:
+                commands[i].retcode = commands[i].retcode or 1
+                commands[i].errors = str(e)
+            finally:
+                done[i].set()
+
+    for j in range(min(jobs, len(targets))):
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+
+    for i, target in enumerate(targets):
+        # Wait with a timeout so SIGINT is still delivered to the main thread
+        while not done[i].wait(1):
+            pass
+        command = commands[i]
+        if command.retcode:
+            raise Retcode(command.cmd, command.retcode,
+                          output=command.errors, elapsed=command.elapsed)
+        sys.stderr.write("[INFO] %s took %.1f second(s)\n"
+                         % (target, command.elapsed))
+
+        # Only the first target's header is kept
+        for line in outputs[i][(1 if i else 0):]:
+            yield line
+        outputs[i] = None
+
+
+def get_zfs_space(targets=None, depth=None, jobs=1):
+    """
+    Parse the output of `zfs list -o space` one line at a time. The header
+    is generated first followed by a row for each dataset with sizes in
+    bytes. A `zfs list` is executed for each target, or each pool if there
+    are no targets, so the collection time of each is reported. With more
+    than one job they are executed concurrently and the rows are merged in
+    target order.
+
+    Inputs:
+        targets (list): Pools or dataset roots, all datasets if None
+        depth    (int): Maximum depth below each root, unlimited if None
+        jobs     (int): Number of concurrent `zfs list` commands
+    Outputs:
+        row (list): Header or dataset row, generated for each line
+    """
+    start = time.time()
+    if jobs > 1:
+        lines = collect(targets or get_pools(), depth, jobs)
+    else:
+        lines = collect_serial(targets or get_pools(), depth)
+
+    try:
+        header = True
+        for line in lines:
+            row = line.split()
+            if header:
+                header = False
+            else:
+                row[1:] = [int(x) for x in row[1:]]
+            yield row
+    except Retcode, r:
+        print "[ERROR] Command execution failed"
+        print r.output.strip()
+        sys.exit(1)
+
+    sys.stderr.write("[INFO] collection took %.1f second(s)\n"
+                     % (time.time() - start))
+
+
+def format_row(row, unit):
+    """
+    Convert the sizes of a dataset row to the defined unit.
+
+    Inputs:
+        row  (list): Dataset row with sizes in bytes
+        unit  (str): Unit, e.g. B,K,M,G,T
+    Outputs:
+        row (list): Dataset row with formatted sizes
+    """
+    return row[:1] + ["%.1f%s" % (float(x / units[unit]), unit)
+                      for x in row[1:]]
 
 
 def main():
     """
     Main function.
     """
+    # Define command line options
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], ":ho:p:D:d:j:",
+                                   ["help", "format=", "pool=", "dataset=",
+                                    "depth=", "jobs="])
+    except getopt.GetoptError, err:
+        sys.stderr.write(str(err))
+        usage()
+        sys.exit(2)
+
+    # Initialize arguments
+    fmt = "csv"
+    targets = []
+    depth = None
+    jobs = 1
+
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif o in ("-o", "--format"):
+            if a not in formats:
+                sys.stderr.write("The output format must be one of %s.\n"
+                                 % ", ".join(formats))
+                sys.exit(1)
+            fmt = a
+        elif o in ("-p", "--pool", "-D", "--dataset"):
+            targets.append(a)
+        elif o in ("-d", "--depth"):
+            try:
+                depth = int(a)
+            except ValueError:
+                sys.stderr.write("The depth must be an integer value.\n")
+                sys.exit(1)
+            if depth < 0:
+                sys.stderr.write("The depth must not be negative.\n")
+                sys.exit(1)
+        elif o in ("-j", "--jobs"):
+            try:
+                jobs = int(a)
+            except ValueError:
+                sys.stderr.write("The number of jobs must be an integer "
+                                 "value.\n")
+                sys.exit(1)
+            if jobs < 1:
+                sys.stderr.write("The number of jobs must be greater than "
+                                 "zero.\n")
+                sys.exit(1)
+
     unit = "K"
     date = time.strftime('%Y%m%d-%H%M', time.localtime(int(time.time())))
     hostname = get_hostname()
-    ofile = "%s-%s-storage-report.csv" % (date, hostname)
+    ofile = "%s-%s-storage-report.%s" % (date, hostname, fmt)
 
     # Open output file
     try:
@@ -125,14 +379,28 @@ def main():
         sys.stderr.write(err)
         sys.exit(1)
 
-    space = get_zfs_space(unit)
-    for row in space:
-        fhandle.write("%s\n" % ",".join(row))
+    # Rows are saved as they are read, the CSV report keeps formatted sizes
+    space = None
+    writer = None
+    for row in get_zfs_space(targets, depth, jobs):
+        if writer is None:
+            writer = get_writer(fmt, row, fhandle=fhandle)
+            space = Table(row)
+            continue
+        formatted = format_row(row, unit)
+        if fmt == "csv":
+            writer.write(formatted)
+        else:
+            writer.write(row)
+        space.append(formatted)
 
     # Close file
+    if writer is not None:
+        writer.close()
     fhandle.close()
 
-    pprint_table(space)
+    if space is not None:
+        space.render()
 
     print ""
     print "Output saved to %s." % ofile
@@ -0,0 +1,109 @@
+"""
+writers.py
+
+Machine-readable output shared by the reporting tools. Rows are written as
+they are produced so a report never has to be held in memory.
+
+Copyright (c) 2016  Nexenta Systems
+William Kettler <william.kettler@nexenta.com>
+"""
+
+import sys
+import csv
+import json
+
+# Supported output formats
+formats = ["csv", "json", "ndjson"]
+
+
+class Writer(object):
+    """
+    Write rows of a table with the given fields. Rows are sequences in field
+    order.
+    """
+    def __init__(self, fields, fhandle=None, header=True):
+        """
+        Inputs:
+            fields  (list): Field names
+            fhandle (file): Output file, defaults to STDOUT
+            header  (bool): Write a header, if the format has one
+        """
+        self.fields = list(fields)
+        self.fhandle = fhandle or sys.stdout
+        self.header = header
+        self.rows = 0
+
+    def write(self, row):
+        self.rows += 1
+
+    def close(self):
+        self.fhandle.flush()
+
+
+class CSVWriter(Writer):
+    """
+    Write rows as CSV with an optional header line.
+    """
+    def __init__(self, fields, fhandle=None, header=True):
+        super(CSVWriter, self).__init__(fields, fhandle, header)
+        self.writer = csv.writer(self.fhandle, lineterminator="\n")
+        if header:
+            self.writer.writerow(self.fields)
+
+    def write(self, row):
+        super(CSVWriter, self).write(row)
+        self.writer.writerow(row)
+
+
+class JSONWriter(Writer):
+    """
+    Write rows as a JSON array of objects. The array is opened with the
+    first row and closed by close().
+    """
+    def write(self, row):
+        if self.rows:
+            self.fhandle.write(",\n ")
+        else:
+            self.fhandle.write("[")
+        super(JSONWriter, self).write(row)
+        json.dump(dict(zip(self.fields, row)), self.fhandle, sort_keys=True)
+
+    def close(self):
+        if self.rows:
+            self.fhandle.write("]\n")
+        else:
+            self.fhandle.write("[]\n")
+        super(JSONWriter, self).close()
+
+
+class NDJSONWriter(Writer):
+    """
+    Write rows as newline delimited JSON, one object per line.
+    """
+    def write(self, row):
+        super(NDJSONWriter, self).write(row)
+        self.fhandle.write("%s\n" % json.dumps(dict(zip(self.fields, row)),
+                                               sort_keys=True))
+
+
+def get_writer(fmt, fields, fhandle=None, header=True):
+    """
+    Return a writer for an output format.
+
+    Inputs:
+        fmt      (str): Output format, one of formats
+        fields  (list): Field names
+        fhandle (file): Output file, defaults to STDOUT
+        header  (bool): Write a header, if the format has one
+    Outputs:
+        writer (Writer): Writer
+    """
+    writers = {
+        "csv": CSVWriter,
+        "json": JSONWriter,
+        "ndjson": NDJSONWriter
+    }
+    if fmt not in writers:
+        raise ValueError("Unsupported output format '%s'" % fmt)
+
+    return writers[fmt](fields, fhandle=fhandle, header=header)